@@ -9,7 +9,12 @@ Read data from API.
 import os, sys, getopt
 import requests
 import json
+import re
+import glob
+from concurrent.futures import ThreadPoolExecutor
 from time import localtime, strftime
+import scheduler
+import prommetrics
 
 import configparser
 cfgsec = "API"
@@ -21,24 +26,158 @@ if not cfg.has_section(cfgsec):
 # continue w/ [cfgsec] config
 
 apihost = cfg.get(cfgsec,"hostname") if cfg.has_option(cfgsec,"hostname") else None
+# "https" or "http" (e.g. for a local stand-in like throttle-server.py)
+apischeme = cfg.get(cfgsec,"scheme") if cfg.has_option(cfgsec,"scheme") else "https"
 apiuri = cfg.get(cfgsec,"uri") if cfg.has_option(cfgsec,"uri") else None
 apiuser = cfg.get(cfgsec,"username") if cfg.has_option(cfgsec,"username") else exit("No username in config. Exit.")
 apipass = cfg.get(cfgsec,"password") if cfg.has_option(cfgsec,"password") else exit("No password in config. Exit.")
 apikey = cfg.get(cfgsec,"apikey") if cfg.has_option(cfgsec,"apikey") else exit("No apikey in config. Exit.")
+# requests per second (0 for no ceiling) and max requests in flight
+ratelimit = cfg.getfloat(cfgsec,"ratelimit") if cfg.has_option(cfgsec,"ratelimit") else 0
+maxworkers = cfg.getint(cfgsec,"maxworkers") if cfg.has_option(cfgsec,"maxworkers") else 4
+apischeduler = scheduler.Scheduler(ratelimit,maxworkers)
 
 
 def show(message):
   print(strftime("%Y-%m-%d %H:%M:%S", localtime())+" "+message)
 
-def load(secure,hostname,uri,api,locale,output,size,split,verbose):
-  global apiuser, apipass, apikey
+# characters that matter when scanning JSON, outside and inside of strings
+jsonspecial = re.compile(rb'[{}\[\]",:]')
+jsonstring = re.compile(rb'["\\]')
+
+class PageScanner:
+  """
+  Incremental scan of one page (JSON object) of Pure API response.
+
+  Bytes of the "items" array (without brackets) are passed to sink as
+  they come and items are only counted. Values of top-level keys in
+  keep (small ones like "count" and "navigationLinks") are parsed.
+  """
+  def __init__(self, sink=None, keep=("count","navigationLinks")):
+    self.sink = sink
+    self.keep = keep
+    self.values = {}
+    self.items = 0
+    self.depth = 0
+    self.instr = False # inside a string
+    self.esc = False # previous byte was a backslash in a string
+    self.expectkey = False
+    self.key = None # top-level key being read or whose value we're in
+    self.keybuf = None # bytes of top-level key while reading it
+    self.capture = None # bytes of value of key in keep
+    self.initems = False
+
+  def endvalue(self, data):
+    if self.capture is not None:
+      self.capture += data
+      self.values[self.key] = json.loads(self.capture.decode("utf-8"))
+      self.capture = None
+    self.key = None
+
+  def feed(self, chunk):
+    pos = 0
+    mark = 0 # start of key, captured value or items in this chunk
+    while pos < len(chunk):
+      if self.instr:
+        if self.esc:
+          self.esc = False
+          pos += 1
+          continue
+        m = jsonstring.search(chunk, pos)
+        if not m: break
+        pos = m.end()
+        if m.group() == b'\\':
+          self.esc = True
+        else:
+          self.instr = False
+          if self.keybuf is not None:
+            self.keybuf += chunk[mark:pos-1]
+            self.key = self.keybuf.decode("utf-8")
+            self.keybuf = None
+        continue
+      m = jsonspecial.search(chunk, pos)
+      if not m: break
+      c = m.group()
+      pos = m.end()
+      if c == b'"':
+        self.instr = True
+        if self.depth == 1 and self.expectkey:
+          self.expectkey = False
+          self.keybuf = bytearray()
+          mark = pos
+      elif c == b'{' or c == b'[':
+        if self.depth == 1 and self.key == "items" and c == b'[':
+          self.initems = True
+          mark = pos
+        elif self.depth == 2 and self.initems:
+          self.items += 1
+        self.depth += 1
+        if self.depth == 1:
+          self.expectkey = True
+      elif c == b'}' or c == b']':
+        self.depth -= 1
+        if self.depth == 1 and self.initems:
+          self.initems = False
+          if self.sink: self.sink(chunk[mark:pos-1])
+        elif self.depth == 0:
+          self.endvalue(chunk[mark:pos-1])
+      elif c == b',':
+        if self.depth == 1:
+          self.endvalue(chunk[mark:pos-1])
+          self.expectkey = True
+      elif c == b':':
+        if self.depth == 1 and self.key in self.keep:
+          self.capture = bytearray()
+          mark = pos
+    # rest of chunk belongs to whatever is going on
+    if self.initems:
+      if self.sink: self.sink(chunk[mark:])
+    elif self.capture is not None:
+      self.capture += chunk[mark:]
+    elif self.keybuf is not None:
+      self.keybuf += chunk[mark:]
+
+  def close(self):
+    if self.depth != 0 or self.instr:
+      raise ValueError("Incomplete JSON page")
+
+class ItemsWriter:
+  """
+  Write items of all pages to one file like {"items":[...]} as they
+  stream in.
+  """
+  def __init__(self, file):
+    self.f = open(file, "wb")
+    self.f.write(b'{"items":[')
+    self.empty = True # no items written yet
+    self.pagestarted = False
+
+  def page(self):
+    self.pagestarted = False
+
+  def write(self, data):
+    if not self.pagestarted:
+      data = data.lstrip()
+      if not data: return
+      if not self.empty: self.f.write(b",")
+      self.pagestarted = True
+      self.empty = False
+    self.f.write(data)
+
+  def close(self):
+    self.f.write(b"]}")
+    self.f.close()
+
+def load(secure,hostname,uri,api,locale,output,size,split,verbose,stream=False):
+  global apiuser, apipass, apikey, apischeduler
   if verbose: show("begin")
+  apischeduler.verbose = verbose
 
   # REQUESTS
   # nb! could use requests.get *params* but since
   #     Pure API provides navigation links with params (full URI)
   #     we produce similar URI to begin with
-  requri = 'https://%s%s/%s'%(hostname,uri,api,)
+  requri = '%s://%s%s/%s'%("https" if secure else "http",hostname,uri,api,)
   requri += '?navigationLink=true&size=%d&offset=%d'%(size,0,)
   if locale:
     requri += '&locale=%s'%(locale,)
@@ -46,6 +185,8 @@ def load(secure,hostname,uri,api,locale,output,size,split,verbose):
   reqheaders['api-key'] = apikey    
   
   fullset = json.loads('{"items":[]}')
+  if stream:
+    writer = ItemsWriter(output) if output else None
   thereismore = True # load until theres no more left (via navigationLink.href)
   index = 0 # increment immediately
   cnt = 0
@@ -55,7 +196,7 @@ def load(secure,hostname,uri,api,locale,output,size,split,verbose):
 
     try:
       if verbose>1: show("call: "+requri)
-      r = requests.get(requri, headers=reqheaders, auth=(apiuser, apipass))
+      r = apischeduler.get(requri, headers=reqheaders, auth=(apiuser, apipass), stream=stream)
     except requests.exceptions.RequestException as e:
       print(e)
       print(requests)
@@ -66,8 +207,31 @@ def load(secure,hostname,uri,api,locale,output,size,split,verbose):
       sys.exit(2)
 
     try:
-      result = json.loads(r.content)
-      if output:
+      if stream:
+        # nb! items are never parsed, only passed on as bytes
+        pagefile = None
+        if output and split: # special case
+          (pre,ext) = output.split(".", -1)
+          outputfile = (pre+"-{:04d}."+ext).format(index,)
+          if verbose: show("saving to "+outputfile)
+          pagefile = open(outputfile, "wb")
+        if writer: writer.page()
+        scanner = PageScanner(writer.write if writer else None)
+        try:
+          for chunk in r.iter_content(chunk_size=65536):
+            if pagefile: pagefile.write(chunk)
+            scanner.feed(chunk)
+            prommetrics.inc("pure_bytes_downloaded_total", len(chunk), api=api)
+          scanner.close()
+        finally:
+          if pagefile: pagefile.close()
+        result = scanner.values
+        pageitems = scanner.items
+      else:
+        result = json.loads(r.content)
+        pageitems = len(result["items"])
+        prommetrics.inc("pure_bytes_downloaded_total", len(r.content), api=api)
+      if output and not stream:
         fullset["items"] += result["items"]
         with open(output, "w") as f:
           json.dump(fullset, f)
@@ -82,7 +246,9 @@ def load(secure,hostname,uri,api,locale,output,size,split,verbose):
       sys.exit(3)
 
     #show(str(result["count"]))
-    cnt+=len(result["items"])
+    cnt+=pageitems
+    prommetrics.inc("pure_pages_fetched_total", api=api)
+    prommetrics.inc("pure_items_fetched_total", pageitems, api=api)
     if verbose: show("index: "+str(index)+" with "+str(cnt)+" items (total "+str(result["count"])+")")
 
     # keep loading?
@@ -93,11 +259,93 @@ def load(secure,hostname,uri,api,locale,output,size,split,verbose):
             requri = nav["href"]
             thereismore = True
   
+  if stream and writer:
+    writer.close()
+
   if verbose and output:
     show("wrote %d items to %s"%(cnt,output,))
 
   if verbose: show("ready")
 
+# uuids referenced from personAssociations of research outputs by API name
+def referenceduuids(api,files,verbose):
+  uuids = set()
+  for file in files:
+    if verbose: show("read references from "+file)
+    with open(file, "rb") as f:
+      items = json.load(f)["items"]
+    for j in items:
+      for a in j.get("personAssociations", []):
+        if api == "persons" and "person" in a:
+          uuids.add(a["person"]["uuid"])
+        if api == "external-persons" and "externalPerson" in a:
+          uuids.add(a["externalPerson"]["uuid"])
+        if api == "external-organisations":
+          for b in a.get("externalOrganisations", []):
+            uuids.add(b["uuid"])
+  return sorted(uuids)
+
+# load only items referenced from research outputs in batched queries
+# by uuids, concurrently (paced by scheduler)
+def loadreferenced(secure,hostname,uri,api,locale,output,size,split,verbose,referenced):
+  global apiuser, apipass, apikey, apischeduler
+  if verbose: show("begin")
+  apischeduler.verbose = verbose
+
+  files = sorted(glob.glob(referenced)) if re.search(r"[*?[]", referenced) else [referenced]
+  if not files: exit("No files for %s. Exit."%(referenced,))
+  uuids = referenceduuids(api,files,verbose)
+  batches = [ uuids[b:b+size] for b in range(0, len(uuids), size) ]
+  if verbose: show("%d %s referenced, %d queries"%(len(uuids),api,len(batches),))
+
+  requri = '%s://%s%s/%s'%("https" if secure else "http",hostname,uri,api,)
+  if locale:
+    requri += '?locale=%s'%(locale,)
+  reqheaders = {'Accept': 'application/json', 'Content-Type': 'application/json'}
+  reqheaders['api-key'] = apikey
+
+  def loadbatch(batch):
+    query = {"uuids": batch, "size": len(batch), "offset": 0}
+    try:
+      if verbose>1: show("call: %s with %d uuids"%(requri,len(batch),))
+      r = apischeduler.post(requri, headers=reqheaders, auth=(apiuser, apipass), data=json.dumps(query))
+    except requests.exceptions.RequestException as e:
+      print(e)
+      print(requests)
+      sys.exit(1)
+
+    if r.status_code != 200:
+      print("Error! HTTP status code: " + str(r.status_code))
+      sys.exit(2)
+    return r.content
+
+  fullset = {"items": []}
+  with ThreadPoolExecutor(max_workers=apischeduler.maxworkers) as executor:
+    for (index,content) in enumerate(executor.map(loadbatch, batches), 1):
+      try:
+        result = json.loads(content)
+      except ValueError as e:
+        print(e)
+        sys.exit(3)
+      fullset["items"] += result["items"]
+      prommetrics.inc("pure_pages_fetched_total", api=api)
+      prommetrics.inc("pure_items_fetched_total", len(result["items"]), api=api)
+      prommetrics.inc("pure_bytes_downloaded_total", len(content), api=api)
+      if verbose: show("index: "+str(index)+" with "+str(len(fullset["items"]))+" items (total "+str(len(uuids))+")")
+      if output and split: # special case
+        (pre,ext) = output.split(".", -1)
+        outputfile = (pre+"-{:04d}."+ext).format(index,)
+        if verbose: show("saving to "+outputfile)
+        with open(outputfile, "wb") as f:
+          f.write(content)
+
+  if output:
+    with open(output, "w") as f:
+      json.dump(fullset, f)
+    if verbose: show("wrote %d items to %s"%(len(fullset["items"]),output,))
+
+  if verbose: show("ready")
+
 def usage():
   print("""usage: get-pure.py [OPTIONS] <API>
 
@@ -120,14 +368,24 @@ OPTIONS
                       with pattern like "api.json" => "api-0001.json"
                       defaults to "<API>.json"
 -S, --split         : split files with max <size> entries each
+-Z, --stream        : stream responses straight to file(s)
+                      without parsing the items (less CPU and memory)
+-M, --metrics <file>: write metrics of the run to <file> in Prometheus
+                      text format (for node_exporter textfile collector)
+-R, --referenced <file>
+                    : load only items referenced from research outputs
+                      in <file> (or quoted glob pattern of split files)
+                      in concurrent queries of max <size> uuids each
+                      for APIs persons, external-persons and
+                      external-organisations
 -v, --verbose       : increase verbosity
 -q, --quiet         : reduce verbosity
 """)
 
 def main(argv):
-  global apihost, apiuri
+  global apihost, apiuri, apischeme
   # variables from arguments with possible defaults
-  secure = True # always secure, so not even argumented anymore!
+  secure = apischeme != "http" # secure unless configured otherwise
   hostname = apihost or os.getenv("PURE_HOSTNAME")
   uri = apiuri or os.getenv("PURE_URI")
   api = None
@@ -135,10 +393,13 @@ def main(argv):
   size = 1000
   output = None
   split = False
+  stream = False
+  referenced = None
+  metricsfile = None
   verbose = 1 # default minor messages
 
   try:
-    opts, args = getopt.getopt(argv,"hH:u:L:O:s:Svq",["help","host=","uri=","locale=","output=","size=","split","verbose","quiet"])
+    opts, args = getopt.getopt(argv,"hH:u:L:O:s:SZR:M:vq",["help","host=","uri=","locale=","output=","size=","split","stream","referenced=","metrics=","verbose","quiet"])
   except getopt.GetoptError as err:
     print(err)
     usage()
@@ -155,6 +416,9 @@ def main(argv):
     elif opt in ("-O", "--output"): output = arg
     elif opt in ("-s", "--size"): size = int(arg)
     elif opt in ("-S", "--split"): split = True
+    elif opt in ("-Z", "--stream"): stream = True
+    elif opt in ("-R", "--referenced"): referenced = arg
+    elif opt in ("-M", "--metrics"): metricsfile = arg
     elif opt in ("-v", "--verbose"): verbose += 1
     elif opt in ("-q", "--quiet"): verbose -= 1
 
@@ -168,7 +432,17 @@ def main(argv):
   if not output:
     output = api+".json"
 
-  load(secure,hostname,uri,api,locale,output,size,split,verbose)
+  if referenced and api not in ("persons","external-persons","external-organisations"):
+    exit("No references to %s in research outputs. Exit."%(api,))
+
+  with prommetrics.stage("load", script="get-pure", api=api):
+    if referenced:
+      loadreferenced(secure,hostname,uri,api,locale,output,size,split,verbose,referenced)
+    else:
+      load(secure,hostname,uri,api,locale,output,size,split,verbose,stream)
+
+  if metricsfile:
+    prommetrics.write(metricsfile, script="get-pure", api=api)
 
 if __name__ == "__main__":
   main(sys.argv[1:])
@@ -5,11 +5,20 @@
 jufo
 
 Module to read data from JUFO REST API.
+
+Besides one channel at a time (get) a full snapshot of channels can be
+imported (importsnapshot) to a local SQLite database and yearly levels
+of many channels read from it at once (lookup).
 """
 import os, sys, getopt
 import requests
 import json
-from time import localtime, strftime
+import csv
+import re
+import sqlite3
+from time import localtime, strftime, time
+import scheduler
+import prommetrics
 
 import configparser
 cfgsec = "API"
@@ -21,68 +30,222 @@ if not cfg.has_section(cfgsec):
 # continue w/ [cfgsec] config
 
 apihost = cfg.get(cfgsec,"hostname") if cfg.has_option(cfgsec,"hostname") else None
+# "https" or "http" (e.g. for a local stand-in like throttle-server.py)
+apischeme = cfg.get(cfgsec,"scheme") if cfg.has_option(cfgsec,"scheme") else "https"
 apiuri = cfg.get(cfgsec,"uri") if cfg.has_option(cfgsec,"uri") else None
+# URI of bulk query returning all channels (as a JSON list) for snapshot
+bulkuri = cfg.get(cfgsec,"bulkuri") if cfg.has_option(cfgsec,"bulkuri") else None
+# requests per second (0 for no ceiling) and max requests in flight
+# nb! JUFO API is shared infrastructure, be gentle
+ratelimit = cfg.getfloat(cfgsec,"ratelimit") if cfg.has_option(cfgsec,"ratelimit") else 2
+maxworkers = cfg.getint(cfgsec,"maxworkers") if cfg.has_option(cfgsec,"maxworkers") else 4
+apischeduler = scheduler.Scheduler(ratelimit,maxworkers)
 cfgsec = "LOCAL"
 datadir = cfg.get(cfgsec,"datadir") if cfg.has_option(cfgsec,"datadir") else "."
 datadir += "/"
+# days after which a cached entry is revalidated from API (none: trust cache forever)
+maxage = cfg.getfloat(cfgsec,"maxage") if cfg.has_option(cfgsec,"maxage") else None
+# snapshot database (in datadir)
+snapshot = cfg.get(cfgsec,"snapshot") if cfg.has_option(cfgsec,"snapshot") else "jufo.db"
 
 def show(message):
   print(strftime("%Y-%m-%d %H:%M:%S", localtime())+" "+message)
 
 def put(file,data,verbose=0):
   global datadir
-  with open(datadir+output, "w") as f:
+  with open(datadir+file, "w") as f:
     json.dump(data, f)
 
-def get(code,verbose=0):
-  global apihost, apiuri, datadir
-  if verbose: show("begin")
-  if not code: return
-
+# cache entry for code is a pair of files:
+# jufo_<code>.json      -- data as returned by API
+# jufo_<code>.meta.json -- ETag/Last-Modified of response and time of last check
+def readcache(code):
+  global datadir
   jufodata = None
-
-  # try to read from already loaded file
+  meta = {}
   filename = datadir+"jufo_%s.json"%(code,)
   if os.path.exists(filename):
     with open(filename, "r") as f:
       jufodata = json.load(f)
+  filename = datadir+"jufo_%s.meta.json"%(code,)
+  if os.path.exists(filename):
+    with open(filename, "r") as f:
+      meta = json.load(f)
+  return (jufodata,meta)
 
-  if jufodata:
+def writecache(code,jufodata,meta):
+  if jufodata is not None:
+    put("jufo_%s.json"%(code,),jufodata)
+  put("jufo_%s.meta.json"%(code,),meta)
+
+def get(code,verbose=0,refresh=False):
+  global apihost, apiuri, apischeme, datadir, maxage, apischeduler
+  if verbose: show("begin")
+  if not code: return
+
+  # try to read from already loaded file
+  (jufodata,meta) = readcache(code)
+
+  stale = refresh
+  if maxage is not None:
+    stale = stale or time()-meta.get("checked",0) > maxage*86400
+
+  if jufodata and not stale:
     if verbose: show("%s read from file"%(code,))
+    prommetrics.inc("pure_jufo_cache_total", result="hit")
     return jufodata
 
-  # load from API if no file was found
+  # load from API if no file was found or it needs revalidation
 
   # REQUESTS
   # nb! could use requests.get *params* but since
   #     Pure API provides navigation links with params (full URI)
   #     we produce similar URI to begin with
-  requri = 'https://%s%s/%s'%(apihost,apiuri,code,)
+  requri = '%s://%s%s/%s'%(apischeme,apihost,apiuri,code,)
   reqheaders = {'Accept': 'application/json'}
+  if jufodata:
+    # conditional request: unchanged data costs a 304 with no body
+    if "etag" in meta: reqheaders['If-None-Match'] = meta["etag"]
+    if "last-modified" in meta: reqheaders['If-Modified-Since'] = meta["last-modified"]
   
   try:
     if verbose>1: show("call: "+requri)
-    r = requests.get(requri, headers=reqheaders)
+    r = apischeduler.get(requri, headers=reqheaders)
   except requests.exceptions.RequestException as e:
+    if jufodata: return usecached(code,jufodata,e)
     print(e)
     print(requests)
     sys.exit(1)
 
+  if r.status_code == 304 and jufodata:
+    if verbose: show("%s not modified"%(code,))
+    prommetrics.inc("pure_jufo_cache_total", result="revalidated")
+    meta["checked"] = time()
+    writecache(code,None,meta)
+    return jufodata
+
   if r.status_code != 200:
+    if jufodata: return usecached(code,jufodata,"HTTP status code: " + str(r.status_code))
     print("Error! HTTP status code: " + str(r.status_code))
     sys.exit(2)
 
   try:
     result = json.loads(r.content)
   except ValueError as e:
+    if jufodata: return usecached(code,jufodata,e)
     print(e)
     sys.exit(3)
 
   if verbose>1: show(result[0]["Jufo_ID"])
+  prommetrics.inc("pure_jufo_cache_total", result="miss")
+
+  # store for later use
+  meta = {"checked": time()}
+  if "ETag" in r.headers: meta["etag"] = r.headers["ETag"]
+  if "Last-Modified" in r.headers: meta["last-modified"] = r.headers["Last-Modified"]
+  writecache(code,result,meta)
 
   if verbose: show("ready")
   return result
 
+# revalidation failed (outage, retired channel...) but cached data is
+# better than nothing: warn and use it, try again next time
+def usecached(code,jufodata,error):
+  print("Warning! Using cached data of %s, revalidation failed: %s"%(code,error,))
+  prommetrics.inc("pure_jufo_cache_total", result="stale")
+  return jufodata
+
+# Snapshot: table channel has every imported channel (even one with
+# no levels) and table level the yearly level of each channel as in
+# "Jufo_<year>" values of API data
+def opensnapshot():
+  global datadir, snapshot
+  db = sqlite3.connect(datadir+snapshot)
+  db.execute("CREATE TABLE IF NOT EXISTS channel (jufo_id TEXT NOT NULL PRIMARY KEY)")
+  db.execute("CREATE TABLE IF NOT EXISTS level (jufo_id TEXT NOT NULL, year INTEGER NOT NULL, level TEXT, PRIMARY KEY (jufo_id, year))")
+  return db
+
+# channels (like API data) from a dump file: JSON list of channels
+# (or {"items":[...]}) or CSV with columns Jufo_ID and Jufo_<year>
+def readdump(file):
+  with open(file, "r", encoding="UTF-8", newline="") as f:
+    if file.lower().endswith(".csv"):
+      dialect = csv.Sniffer().sniff(f.read(65536), delimiters=";,\t")
+      f.seek(0)
+      return list(csv.DictReader(f, dialect=dialect))
+    channels = json.load(f)
+  if isinstance(channels, dict):
+    channels = channels["items"]
+  return channels
+
+def readbulk(verbose=0):
+  global apihost, apischeme, bulkuri, apischeduler
+  if not bulkuri: exit("No bulkuri in config. Exit.")
+  requri = '%s://%s%s'%(apischeme,apihost,bulkuri,)
+  try:
+    if verbose>1: show("call: "+requri)
+    r = apischeduler.get(requri, headers={'Accept': 'application/json'})
+  except requests.exceptions.RequestException as e:
+    print(e)
+    print(requests)
+    sys.exit(1)
+
+  if r.status_code != 200:
+    print("Error! HTTP status code: " + str(r.status_code))
+    sys.exit(2)
+
+  try:
+    return json.loads(r.content)
+  except ValueError as e:
+    print(e)
+    sys.exit(3)
+
+# replace snapshot with all channels from dump file or from API ("api")
+def importsnapshot(source,verbose=0):
+  if verbose: show("begin")
+  channels = readbulk(verbose) if source == "api" else readdump(source)
+  ids = set()
+  rows = []
+  for ch in channels:
+    if not ch.get("Jufo_ID"): continue
+    ids.add(str(ch["Jufo_ID"]))
+    for k,v in ch.items():
+      m = re.search(r"^Jufo_(\d{4})$", k)
+      if m and v not in (None, ""):
+        rows.append((str(ch["Jufo_ID"]),int(m.group(1)),str(v)))
+  db = opensnapshot()
+  with db: # one transaction
+    db.execute("DELETE FROM channel")
+    db.execute("DELETE FROM level")
+    db.executemany("INSERT INTO channel (jufo_id) VALUES (?)", [ (i,) for i in sorted(ids) ])
+    db.executemany("INSERT OR REPLACE INTO level (jufo_id, year, level) VALUES (?,?,?)", rows)
+  db.close()
+  if verbose: show("imported %d levels of %d channels"%(len(rows),len(channels),))
+  return len(channels)
+
+# yearly levels of codes from snapshot like API data: { code: [{"Jufo_ID":code,"Jufo_<year>":level,...}] }
+# nb! codes not in snapshot are left out, channels with no levels are
+#     found with only "Jufo_ID" (and not asked from API again)
+def lookup(codes,verbose=0):
+  global datadir, snapshot
+  found = {}
+  if not os.path.exists(datadir+snapshot): return found
+  codes = [ str(c) for c in codes ]
+  db = opensnapshot()
+  for b in range(0, len(codes), 500): # nb! max number of SQL variables
+    batch = codes[b:b+500]
+    marks = ",".join("?"*len(batch))
+    sql = "SELECT jufo_id FROM channel WHERE jufo_id IN (%s)"%(marks,)
+    for (code,) in db.execute(sql, batch):
+      found[code] = [{"Jufo_ID": code}]
+    sql = "SELECT jufo_id, year, level FROM level WHERE jufo_id IN (%s)"%(marks,)
+    for (code,year,level) in db.execute(sql, batch):
+      found.setdefault(code, [{"Jufo_ID": code}])[0]["Jufo_%d"%(year,)] = level
+  db.close()
+  prommetrics.inc("pure_jufo_cache_total", len(found), result="snapshot")
+  if verbose: show("%d of %d channels found in snapshot"%(len(found),len(codes),))
+  return found
+
 def usage():
   print("""usage: jufo.py [OPTIONS] <CODE>
 
@@ -96,10 +259,17 @@ OPTIONS
                       defaults to configuration value
 -o, --output <file> : filename to write output to
                       defaults to "jufo_<CODE>.json"
+-r, --refresh       : revalidate cached data from API
+                      (unchanged data is not downloaded again)
+-i, --import <file> : import snapshot of all channels instead of <CODE>
+                      from dump file (JSON list of channels or CSV with
+                      columns Jufo_ID and Jufo_<year>) or from API
+                      (bulk query in configuration) if <file> is "api"
 -v, --verbose       : increase verbosity
 -q, --quiet         : reduce verbosity
 
 Or use as a module with: jsondata = jufo.get(<CODE>)
+                   or: jsondata = jufo.lookup([<CODE>, ...])
 """)
 
 def main(argv):
@@ -107,10 +277,12 @@ def main(argv):
   code = None
   output = None
   split = False
+  refresh = False
+  importsource = None
   verbose = 1 # default minor messages
 
   try:
-    opts, args = getopt.getopt(argv,"ho:vq",["help","output=","verbose","quiet"])
+    opts, args = getopt.getopt(argv,"ho:ri:vq",["help","output=","refresh","import=","verbose","quiet"])
   except getopt.GetoptError as err:
     print(err)
     usage()
@@ -122,14 +294,20 @@ def main(argv):
       usage()
       sys.exit(0)
     elif opt in ("-o", "--output"): output = arg
+    elif opt in ("-r", "--refresh"): refresh = True
+    elif opt in ("-i", "--import"): importsource = arg
     elif opt in ("-v", "--verbose"): verbose += 1
     elif opt in ("-q", "--quiet"): verbose -= 1
 
+  if importsource:
+    importsnapshot(importsource,verbose)
+    sys.exit(0)
+
   if not code:
     usage()
     sys.exit(2)
 
-  jufodata = get(code,verbose)
+  jufodata = get(code,verbose,refresh)
 
   if output:
     put(output,jufodata)
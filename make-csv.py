@@ -10,7 +10,7 @@ The flow of this script is as follows:
 1. main      -- command line arguments, flow control
 2. readjson  -- read data from json files, return data objects
              -- uses helper functions jv and getkeywordvalue
-4. output    -- write data to a CSV file
+4. output    -- write data to a CSV file (or to sharded CSV files)
 
 Note:
 TODO? See that CSV section is okay in Pure.cfg
@@ -19,12 +19,27 @@ Possible subject for improvement:
   All JSON files are read into memory. This is something that
   could easily be changed if there appears any performance issues.
 """
-import sys, getopt
+import os, sys, getopt
 import csv
 import json
 import re
+import glob
+import io
+import signal
+import stat
+import hashlib
+import sqlite3
+import threading
+import socketserver
 import configparser
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlsplit, parse_qs
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
+from time import monotonic
 import jufo
+import prommetrics
 
 # values read from config
 keywords = None
@@ -32,6 +47,30 @@ metrics = None
 metricstartyear = None
 metricyears = None
 
+# compact records for lookups (by uuid) from journals, persons etc.
+Journal = namedtuple("Journal", "pureid workflow country")
+Person = namedtuple("Person", "pureid orcid employeeid oodiid masterdbid studentid")
+ExternalPerson = namedtuple("ExternalPerson", "pureid")
+ExternalOrganisation = namedtuple("ExternalOrganisation", "country")
+
+# names of page files of each source when source is a directory, like
+# "research-outputs" for "research-outputs-0001.json" (see sourcefiles)
+# nb! from names of source files in configuration (see main)
+pagenames = {
+  "research": "research-outputs",
+  "journal": "journals",
+  "person": "persons",
+  "externalperson": "external-persons",
+  "externalorganisation": "external-organisations",
+}
+
+# data for research output pages in worker processes (see parsepages, selectedreferences)
+pagecontext = None
+
+# max length of string values to intern when reading json
+# nb! same names, URIs, terms and uuids repeat over and over in Pure data
+internlength = 100
+
 def makerow(verbose):
   #rowheader = columns.copy()
   #rowheader.sort()
@@ -150,23 +189,307 @@ def makerow(verbose):
   ]
   return rowheader
 
-def output(outputfile,items,verbose):
+def writecsv(outputfile,columns,rows,verbose):
+  # write to outputfile (always)
+  # nb! written to a temporary file first, so a run that fails half way
+  #     leaves the previous output as it was
+  with open(outputfile+".tmp", 'w', newline='', encoding="UTF-8") as f:
+    count = writecsvfile(f,outputfile,columns,rows,verbose)
+  os.replace(outputfile+".tmp", outputfile)
+  return count
+
+def writecsvfile(f,name,columns,rows,verbose):
+  writer = csv.DictWriter(f, fieldnames=columns, delimiter=';', quotechar='"', quoting=csv.QUOTE_ALL, extrasaction='ignore')
+  writer.writeheader()
+  count=0
+  for row in rows:
+    count+=1
+    if verbose>2: print("Output CSV (%s) with row: %s"%(name,row,))
+    writer.writerow(row)
+  return count
+
+def checksum(file):
+  sha = hashlib.sha256()
+  with open(file, 'rb') as f:
+    for block in iter(lambda: f.read(65536), b''):
+      sha.update(block)
+  return sha.hexdigest()
+
+# name of a shard file: "research-outputs.csv" => "research-outputs-<key>.csv"
+def shardname(outputfile,key):
+  (pre,ext) = os.path.splitext(outputfile)
+  return pre+"-"+re.sub(r"[^0-9A-Za-z_.-]", "_", key)+ext
+
+def output(outputfile,items,verbose,shardby=None,shardsize=None,workers=1,delta=None,dbfile=None):
   # find the column names:
   #columns = [ x for row in items for x in row.keys() ]
   #columns = list(set(columns))
   columns = makerow(verbose)
 
-  # write to outputfile (always)
-  with open(outputfile, 'w', newline='', encoding="UTF-8") as f:
-    writer = csv.DictWriter(f, fieldnames=columns, delimiter=';', quotechar='"', quoting=csv.QUOTE_ALL, extrasaction='ignore')
+  if delta:
+    items = delta.feed(items)
+
+  if dbfile:
+    count = writesqlite(dbfile,columns,items,verbose)
+  elif not shardby and not shardsize:
+    count = writecsv(outputfile,columns,items,verbose)
+    if verbose: print("Output written to file '%s' with %d columns and %d rows"%(outputfile,len(columns),count,))
+  else:
+    count = writeshards(outputfile,columns,items,verbose,shardby,shardsize,workers)
+
+  # delta files are put in place only when output is written
+  if delta:
+    delta.commit()
+  return count
+
+def writeshards(outputfile,columns,items,verbose,shardby,shardsize,workers):
+  # sharded output: group rows by column value and/or max row count
+  # nb! order of rows inside a shard is kept as is (stable checksums)
+  shards = {} # key => list of rows
+  for row in items:
+    key = ""
+    if shardby:
+      value = row.get(shardby)
+      key = "none" if value is None or value == "" else str(value)
+    shards.setdefault(key, []).append(row)
+  # nb! different keys may end up with the same file name (e.g. "Mäki"
+  #     and "Möki" => "M_ki"), those get a hash of the key as suffix
+  used = set() # file names in lower case (case insensitive file systems)
+  def uniquename(name):
+    file = shardname(outputfile,name)
+    n = 0
+    while file.lower() in used:
+      n += 1
+      file = shardname(outputfile,name+"-"+hashlib.sha1((name+"\x1f"+str(n)).encode("utf-8")).hexdigest()[:8])
+    used.add(file.lower())
+    return file
+
+  parts = [] # (key,file,rows)
+  for key in sorted(shards):
+    rows = shards[key]
+    if shardsize:
+      for n,b in enumerate(range(0, len(rows), shardsize), 1):
+        name = (key+"-" if key else "")+"{:04d}".format(n)
+        parts.append((key,uniquename(name),rows[b:b+shardsize]))
+    else:
+      parts.append((key,uniquename(key),rows))
+
+  def writeshard(part):
+    (key,file,rows) = part
+    count = writecsv(file,columns,rows,verbose)
+    if verbose>1: print("Output shard '%s' written with %d rows"%(file,count,))
+    return {"file": os.path.basename(file), "key": key if shardby else None, "rows": count, "sha256": checksum(file)}
+
+  with ThreadPoolExecutor(max_workers=workers) as executor:
+    files = list(executor.map(writeshard, parts))
+
+  manifestfile = shardname(outputfile,"manifest")
+  manifestfile = os.path.splitext(manifestfile)[0]+".json"
+  # files of previous run (manifest is the list of files that belong to output)
+  previousfiles = []
+  if os.path.exists(manifestfile):
+    try:
+      with open(manifestfile, "r") as f:
+        previousfiles = [ a["file"] for a in json.load(f)["files"] ]
+    except (ValueError, KeyError, TypeError) as e:
+      print("Warning! Could not read previous manifest '%s': %s"%(manifestfile,e,))
+  with open(manifestfile+".tmp", "w") as f:
+    json.dump({"column": shardby, "size": shardsize, "columns": len(columns), "files": files}, f, indent=1)
+  os.replace(manifestfile+".tmp", manifestfile)
+
+  # remove files of previous run that are not part of this output anymore
+  # nb! only files listed in previous manifest, nothing else is touched
+  directory = os.path.dirname(outputfile)
+  current = set(a["file"] for a in files)
+  for file in previousfiles:
+    if file in current or os.path.basename(file) != file: continue
+    file = os.path.join(directory, file)
+    if os.path.exists(file):
+      os.unlink(file)
+      if verbose>1: print("Removed shard '%s' of previous run"%(file,))
+
+  count = sum(a["rows"] for a in files)
+  if verbose: print("Output written to %d files with %d columns and %d rows, manifest in '%s'"%(len(files),len(columns),count,manifestfile,))
+  return count
+
+# SQLite output
+#
+# Rows are split into two tables with columns named exactly like in CSV:
+# research_output -- columns of research output, journal, keywords and
+#                    metrics, one row for each research output
+# person          -- person columns of each CSV row and the research
+#                    output (ro) it belongs to
+# and view "export" joins them back to the flat rows of CSV (in order).
+# nb! columns are taken by position from makerow, person columns being
+#     those from "Person role" to "Person external organisations UUID"
+sqlitebatch = 10000
+
+def personcolumns(columns):
+  return columns[columns.index("Person role"):columns.index("Person external organisations UUID")+1]
+
+def sqlname(name):
+  return '"'+name.replace('"','""')+'"'
+
+# values of other types than text and numbers are stored as text like in CSV
+sqlite3.register_adapter(dict, str)
+sqlite3.register_adapter(list, str)
+
+def writesqlite(dbfile,columns,rows,verbose):
+  pcolumns = personcolumns(columns)
+  rocolumns = [ c for c in columns if c not in pcolumns ]
+  # build to a temporary file, so readers never see a half written database
+  if os.path.exists(dbfile+".tmp"): os.unlink(dbfile+".tmp")
+  db = sqlite3.connect(dbfile+".tmp")
+  # nb! nothing to recover if this fails half way, file is just written again
+  db.execute("PRAGMA journal_mode = OFF")
+  db.execute("PRAGMA synchronous = OFF")
+  db.execute("CREATE TABLE research_output (ro INTEGER PRIMARY KEY, %s)"%(", ".join(sqlname(c) for c in rocolumns),))
+  db.execute("CREATE TABLE person (ro INTEGER NOT NULL REFERENCES research_output (ro), %s)"%(", ".join(sqlname(c) for c in pcolumns),))
+  insertro = "INSERT INTO research_output VALUES (?, %s)"%(", ".join("?"*len(rocolumns)),)
+  insertperson = "INSERT INTO person VALUES (?, %s)"%(", ".join("?"*len(pcolumns)),)
+  count = 0
+  ro = 0
+  previous = None
+  robatch = []
+  personbatch = []
+  with db: # one transaction
+    for row in rows:
+      count += 1
+      if verbose>2: print("Output SQLite (%s) with row: %s"%(dbfile,row,))
+      values = list(map(row.get, rocolumns))
+      # consecutive rows of one research output (one per person) share values
+      if values != previous:
+        ro += 1
+        robatch.append([ro]+values)
+        previous = values
+      personbatch.append([ro]+list(map(row.get, pcolumns)))
+      if len(personbatch) >= sqlitebatch:
+        db.executemany(insertro, robatch)
+        db.executemany(insertperson, personbatch)
+        robatch = []
+        personbatch = []
+    db.executemany(insertro, robatch)
+    db.executemany(insertperson, personbatch)
+    # indexes after data is in, faster than keeping them up to date
+    db.execute('CREATE INDEX research_output_uuid ON research_output ("Research output UUID")')
+    db.execute('CREATE INDEX research_output_year ON research_output ("Research output status year")')
+    db.execute('CREATE INDEX research_output_issn ON research_output ("Journal ISSN")')
+    db.execute('CREATE INDEX person_ro ON person (ro)')
+    db.execute('CREATE INDEX person_uuid ON person ("Person UUID")')
+    db.execute("CREATE VIEW export AS SELECT %s FROM person JOIN research_output USING (ro) ORDER BY person.rowid"%(", ".join(sqlname(c) for c in columns),))
+  db.close()
+  os.replace(dbfile+".tmp", dbfile)
+  if verbose: print("Output written to database '%s' with %d columns, %d rows and %d research outputs"%(dbfile,len(columns),count,ro,))
+  return count
+
+# Delta output against previous export
+#
+# Rows are keyed by research output and person uuids (plus a running
+# number for repeated keys) and compared by a hash of row values. Only
+# the hashes of previous export are held in memory, never the rows.
+deltakey = ["Research output UUID","Person UUID","Person external UUID"]
+
+def digest(values):
+  return hashlib.blake2b("\x1f".join(values).encode("utf-8"), digest_size=8).digest()
+
+class Delta:
+  """
+  Compare rows to previous export (CSV file) or to its fingerprint
+  index and write files (named after outputfile):
+  -added.csv        -- rows not in previous export
+  -changed.csv      -- rows with a key in previous export but other values
+  -removed.csv      -- rows of previous export not found anymore
+                       (only key columns if previous is fingerprint index)
+  -fingerprints.csv -- fingerprint index of this export for next time
+  """
+  def __init__(self, previous, outputfile, columns, verbose):
+    self.previous = previous
+    self.columns = columns
+    self.verbose = verbose
+    # nb! previous export may be the very file this run writes (-P same
+    #     as -O, the usual setup), so everything is written to temporary
+    #     files and put in place by commit only when the whole run has
+    #     succeeded, previous export stays untouched until then
+    self.names = {}
+    for name in ("added","changed","removed","fingerprints"):
+      self.names[name] = shardname(outputfile,name)
+    self.files = {}
+    self.writers = {}
+    for name in ("added","changed","removed"):
+      self.files[name] = open(self.names[name]+".tmp", 'w', newline='', encoding="UTF-8")
+      self.writers[name] = self.csvwriter(self.files[name], columns, 'ignore')
+    self.files["fingerprints"] = open(self.names["fingerprints"]+".tmp", 'w', newline='', encoding="UTF-8")
+    self.writers["fingerprints"] = self.csvwriter(self.files["fingerprints"], deltakey+["Occurrence","Fingerprint"], 'raise')
+    self.counts = {"added": 0, "changed": 0, "removed": 0}
+    self.hashes = {} # key hash => row hash of previous export
+    self.seen = {} # key hash => occurrences in this export
+    for (keyhash,rowhash,key,row) in self.readprevious():
+      self.hashes[keyhash] = rowhash
+    if verbose: print("Read %d fingerprints from previous export '%s'"%(len(self.hashes),previous,))
+
+  def csvwriter(self, f, columns, extrasaction):
+    writer = csv.DictWriter(f, fieldnames=columns, delimiter=';', quotechar='"', quoting=csv.QUOTE_ALL, extrasaction=extrasaction)
     writer.writeheader()
-    count=0
-    for row in items:
-      count+=1
-      if verbose>2: print("Output CSV (%s) with row: %s"%(outputfile,row,))
-      writer.writerow(row)
+    return writer
+
+  # (keyhash,rowhash,key,row) of previous export, row is None from fingerprint index
+  def readprevious(self):
+    occurrences = {}
+    with open(self.previous, 'r', newline='', encoding="UTF-8") as f:
+      reader = csv.DictReader(f, delimiter=';', quotechar='"')
+      isindex = "Fingerprint" in (reader.fieldnames or [])
+      for row in reader:
+        key = [ row.get(c) or "" for c in deltakey ]
+        if isindex:
+          key.append(row["Occurrence"])
+          yield (digest(key),bytes.fromhex(row["Fingerprint"]),key,None)
+        else:
+          keyhash = digest(key)
+          occurrences[keyhash] = occurrences.get(keyhash,0)+1
+          key.append(str(occurrences[keyhash]))
+          yield (digest(key),digest([ row.get(c) or "" for c in self.columns ]),key,row)
 
-  if verbose: print("Output written to file '%s' with %d columns and %d rows"%(outputfile,len(columns),count,))
+  def add(self, row):
+    key = [ "" if row.get(c) is None else str(row.get(c)) for c in deltakey ]
+    keyhash = digest(key)
+    self.seen[keyhash] = self.seen.get(keyhash,0)+1
+    key.append(str(self.seen[keyhash]))
+    keyhash = digest(key)
+    rowhash = digest([ "" if row.get(c) is None else str(row.get(c)) for c in self.columns ])
+    self.writers["fingerprints"].writerow(dict(zip(deltakey+["Occurrence","Fingerprint"], key+[rowhash.hex()])))
+    previous = self.hashes.pop(keyhash, None)
+    if previous is None:
+      self.writers["added"].writerow(row)
+      self.counts["added"] += 1
+    elif previous != rowhash:
+      self.writers["changed"].writerow(row)
+      self.counts["changed"] += 1
+
+  # pass rows thru while comparing them
+  def feed(self, rows):
+    for row in rows:
+      self.add(row)
+      yield row
+    self.close()
+
+  def close(self):
+    # what is left of previous export was removed
+    # nb! read previous export again rather than keep it in memory
+    if self.hashes:
+      for (keyhash,rowhash,key,row) in self.readprevious():
+        if keyhash in self.hashes:
+          if row is None:
+            row = dict(zip(deltakey, key))
+          self.writers["removed"].writerow(row)
+          self.counts["removed"] += 1
+    for f in self.files.values():
+      f.close()
+    if self.verbose: print("Delta to previous export: %d added, %d changed and %d removed rows"%(self.counts["added"],self.counts["changed"],self.counts["removed"],))
+
+  # put files written by close in place
+  def commit(self):
+    for name in ("added","changed","removed","fingerprints"):
+      os.replace(self.names[name]+".tmp", self.names[name])
 
 # Helper functions for repeatedly used part of code
 # get direct value from json with name
@@ -185,18 +508,100 @@ def js_value(objectname,subname,jsonitem):
           value = a["value"]
   return value
 # get last part of objects subelements text value where value is separated by slash (/)
-def jpart(objectname,subname,jsonitem):
+# nb! memo=False for values that do not repeat (ids), they would only
+#     crowd out the URIs in memo table
+def jpart(objectname,subname,jsonitem,memo=True):
   lastpart = None
   if objectname in jsonitem:
     if subname in jsonitem[objectname]:
-      lastpart = jsonitem[objectname][subname].split("/")[-1] # last part of ".../../THIS"
+      if memo:
+        lastpart = uriparts(jsonitem[objectname][subname])[-1] # last part of ".../../THIS"
+      else:
+        lastpart = jsonitem[objectname][subname].split("/")[-1]
   return lastpart
 
+# Memoized transforms of values that repeat over and over in Pure data
+# (URIs, terms). The same few distinct values are transformed millions
+# of times per export so results are kept in bounded tables.
+class Memo:
+  """
+  Bounded memo table of transform(key) with hit counters.
+  Emptied when full (distinct keys are few, so it rarely is).
+  Safe to share between threads (serve mode), counters are approximate.
+  """
+  def __init__(self, name, transform, maxsize=100000):
+    self.name = name
+    self.transform = transform
+    self.maxsize = maxsize
+    self.table = {}
+    self.hits = 0
+    self.misses = 0
+    memos.append(self)
+
+  def __call__(self, key):
+    # nb! one get (not "in" and then []) as another thread may clear table
+    value = self.table.get(key, missing)
+    if value is not missing:
+      self.hits += 1
+      return value
+    self.misses += 1
+    if len(self.table) >= self.maxsize:
+      self.table.clear()
+    value = self.table[key] = self.transform(key)
+    return value
+
+memos = []
+missing = object() # marker for key not in memo table
+
+# parts of URI like "/dk/atira/pure/researchoutput/researchoutputtypes/contributiontojournal/article"
+uriparts = Memo("uriparts", lambda uri: tuple(sys.intern(p) for p in uri.split("/")))
+
+def languagecode(uri):
+  # nb! last part but then split with "_" i.e. "fi_FI" -> "fi"
+  language = uriparts(uri)[-1].split("_")[0]
+  # nb! there are some odd language values for ex. "/dk/atira/pure/core/languages/italian"?
+  if   language=="chinese":        language = "zh"
+  elif language=="italian":        language = "it"
+  elif language=="polish":         language = "pl"
+  elif language=="portuguese":     language = "pt"
+  if language == "und": # value 99 is not used for unknown
+    return None
+  return sys.intern(language)
+languagecode = Memo("language", languagecode)
+
+# name of configured keyword (see keywords) in structured keyword URI or None
+def keywordname(uri):
+  global keywords
+  for k in keywords:
+    if "dk/atira/pure/keywords/"+k+"/" in uri:
+      return k
+  return None
+keywordname = Memo("keyword", keywordname)
+
+# code of core keyword (tieteenalakoodi) from its term, e.g. "612,1 ..." -> "6121"
+def fieldcode(svalue):
+  code_check = svalue
+  code_check = code_check.split(" ")[0]
+  code_check = code_check.replace(",","") # remove comma "," if it exists, e.g. "612,1"->"6121"
+  # nb! as re.search("^"+t+"$", code_check) used to, ignore one trailing newline
+  if code_check.endswith("\n"): code_check = code_check[:-1]
+  return code_check
+fieldcode = Memo("fieldcode", fieldcode)
+
+def memostats(verbose):
+  for memo in memos:
+    prommetrics.setgauge("pure_memo_lookups", memo.hits, table=memo.name, result="hit")
+    prommetrics.setgauge("pure_memo_lookups", memo.misses, table=memo.name, result="miss")
+    if verbose>1:
+      lookups = memo.hits+memo.misses
+      print("Memo %s: %d lookups, %d distinct, hit rate %.1f%%"%(memo.name,lookups,memo.misses,100.0*memo.hits/lookups if lookups else 0,))
+
 # go thru given JSON. Look for bits were interested in and write to output file (CSV)
-def parsejson(jsondata,metricdata,journaldata,persondata,externalpersondata,externalorganisationdata,verbose):
+# nb! rows are yielded one by one (as they are made) so that they can be
+#     written out while the rest is still being made
+def parsejson(jsondata,metricdata,journalindex,personindex,externalpersonindex,externalorganisationindex,verbose):
   global keywords,metrics,metricstartyear,metricyears
 
-  items = []
   for j in jsondata:
     item = {}
     item["Research output Pure ID"] = j["pureId"]
@@ -222,21 +627,13 @@ def parsejson(jsondata,metricdata,journaldata,persondata,externalpersondata,exte
 
     language = None
     if "language" in j:
-      # nb! last part but then split with "_" i.e. "fi_FI" -> "fi"
-      language = jpart("language","uri",j).split("_")[0]
-      # nb! there are some odd language values for ex. "/dk/atira/pure/core/languages/italian"?
-      if   language=="chinese":        language = "zh"
-      elif language=="italian":        language = "it"
-      elif language=="polish":         language = "pl"
-      elif language=="portuguese":     language = "pt"
-      if language == "und": # value 99 is not used for unknown
-        language = None
+      language = languagecode(j["language"]["uri"])
     item["Research output language"] = language
 
     item["Research output type"] = None #jpart("type","uri",j)
     if "type" in j:
       if "uri" in j["type"]:
-        item["Research output type"] = j["type"]["uri"].split("/")[-2] # nb! second last part of ".../../THIS/that"
+        item["Research output type"] = uriparts(j["type"]["uri"])[-2] # nb! second last part of ".../../THIS/that"
     item["Research output subtype"] = jpart("type","uri",j)
     item["Research output category"] = js_value("term","text",j["category"]) #jpart("category","uri",j)
     item["Research output assessment type category"] = None
@@ -289,16 +686,15 @@ def parsejson(jsondata,metricdata,journaldata,persondata,externalpersondata,exte
     item["Journal title"] = journalAssociation_title
     item["Journal type"] = journalAssociation_journal_type
     item["Journal UUID"] = journal_uuid
-    # fetch from journaldata
+    # fetch from journalindex
     item["Journal Pure ID"] = ""
     item["Journal Workflow"] = ""
     item["Journal country"] = ""
-    for a in journaldata:
-      if a["uuid"] == journal_uuid:
-        item["Journal Pure ID"] = a["pureId"]
-        item["Journal Workflow"] = jpart("workflow","workflowStep",a)
-        if "country" in a:
-          item["Journal country"] = js_value("term","text",a["country"])
+    if journal_uuid in journalindex:
+      a = journalindex[journal_uuid]
+      item["Journal Pure ID"] = a.pureid
+      item["Journal Workflow"] = a.workflow
+      item["Journal country"] = a.country
 
     item["Research output volume"] = jv("volume",j)
     item["Research output journal number"] = jv("journalNumber",j)
@@ -336,7 +732,7 @@ def parsejson(jsondata,metricdata,journaldata,persondata,externalpersondata,exte
               if "structuredKeyword" in c:
                 s = c["structuredKeyword"]
                 if "uri" in s:
-                  if "dk/atira/pure/keywords/"+k+"/" in s["uri"]:
+                  if keywordname(s["uri"]) == k:
                     keyword_value = js_value("term","text",s)
               # nb! rinnakkaistallennettuosoite is some what different
               if "rinnakkaistallennettukytkin" == k and keyword_value:
@@ -364,10 +760,8 @@ def parsejson(jsondata,metricdata,journaldata,persondata,externalpersondata,exte
                 if "uri" in s:
                   if "/dk/atira/pure/core/keywords/" in s["uri"]:
                     svalue = js_value("term","text",s)
-                    code_check = svalue
-                    code_check = code_check.split(" ")[0]
-                    code_check = code_check.replace(",","") # remove comma "," if it exists, e.g. "612,1"->"6121"
-                    if re.search("^"+t+"$", code_check):
+                    code_check = fieldcode(svalue)
+                    if code_check == t:
                       if verbose>2: print("%s tieteenalakoodi %s"%(j["uuid"],code_check,))
                       item["Keyword field "+t] = svalue
 
@@ -447,30 +841,20 @@ def parsejson(jsondata,metricdata,journaldata,persondata,externalpersondata,exte
             personAssociations_person_uuid = a["person"]["uuid"]
             if "name" in a["person"]:
               personAssociations_person_name = js_value("name","text",a["person"])
-            for p in persondata:
-              if p["uuid"] == personAssociations_person_uuid:
-                personAssociations_person_pureid = p["pureId"]
-                if "orcid" in p: personAssociations_person_orcid = p["orcid"]
-                # list of ids
-                if "ids" in p:
-                  for i in p["ids"]:
-                    if "type" in i:
-                      if "uri" in i["type"]:
-                        if i["type"]["uri"] == "/dk/atira/pure/person/personsources/employee":
-                          personAssociations_person_employeeid = jpart("value","value",i)
-                        if i["type"]["uri"] == "/dk/atira/pure/person/personsources/oodi":
-                          personAssociations_person_oodiid = jpart("value","value",i)
-                        if i["type"]["uri"] == "/dk/atira/pure/person/personsources/masterdb":
-                          personAssociations_person_masterdbid = jpart("value","value",i)
-                        if i["type"]["uri"] == "/dk/atira/pure/person/personsources/studentid":
-                          personAssociations_person_studentid = jpart("value","value",i)
+            if personAssociations_person_uuid in personindex:
+              p = personindex[personAssociations_person_uuid]
+              personAssociations_person_pureid = p.pureid
+              personAssociations_person_orcid = p.orcid
+              personAssociations_person_employeeid = p.employeeid
+              personAssociations_person_oodiid = p.oodiid
+              personAssociations_person_masterdbid = p.masterdbid
+              personAssociations_person_studentid = p.studentid
           if "externalPerson" in a:
             personAssociations_externalPerson_uuid = a["externalPerson"]["uuid"]
-            for p in externalpersondata:
-              if p["uuid"] == personAssociations_externalPerson_uuid:
-                # should not replace but same field yes
-                personAssociations_person_pureid = p["pureId"]
-                # nb! external persons do not have internal ids
+            if personAssociations_externalPerson_uuid in externalpersonindex:
+              # should not replace but same field yes
+              personAssociations_person_pureid = externalpersonindex[personAssociations_externalPerson_uuid].pureid
+              # nb! external persons do not have internal ids
           # person organisational data
           if "organisationalUnits" in a:
             for b in a["organisationalUnits"]:
@@ -480,11 +864,10 @@ def parsejson(jsondata,metricdata,journaldata,persondata,externalpersondata,exte
             for b in a["externalOrganisations"]:
               personAssociations_externalOrganisations_uuid = b["uuid"]
               personAssociations_externalOrganisations_name = js_value("name","text",b)
-              for o in externalorganisationdata:
-                if o["uuid"] == b["uuid"]:
-                  if "address" in o:
-                    if "country" in o["address"]:
-                      personAssociations_externalOrganisations_country = js_value("term","text",o["address"]["country"])
+              if b["uuid"] in externalorganisationindex:
+                o = externalorganisationindex[b["uuid"]]
+                if o.country is not None:
+                  personAssociations_externalOrganisations_country = o.country
           # add person values to item here, overwrite if 1+ round
           item["Person role"] = personAssociations_personRole
           item["Person first name"] = personAssociations_name_firstName
@@ -506,7 +889,7 @@ def parsejson(jsondata,metricdata,journaldata,persondata,externalpersondata,exte
           item["Person external organisations UUID"] = personAssociations_externalOrganisations_uuid
 
           # and append here (not at "root" loop end)
-          items.append(item.copy()) #nb! make a copy (not reference)
+          yield item.copy() #nb! make a copy (not reference)
         #/roleIsOK
       #/
     #/personAssociations
@@ -517,20 +900,51 @@ def parsejson(jsondata,metricdata,journaldata,persondata,externalpersondata,exte
     # if no person was found then append here
     if not added_persons:
       if verbose: print("No person for: %s"&(item["uuid"],))
-      items.append(item.copy()) #nb! make a copy (not reference)
+      yield item.copy() #nb! make a copy (not reference)
+
+# get jufo data for all journals with a jufo id, concurrently
+# nb! jufo module paces the actual API calls (see scheduler)
+def getjufo(journaldata,verbose,juforefresh=False):
+  jufoids = []
+  for jo in journaldata:
+    if "externalIdSource" in jo and "externalId" in jo:
+      if "jufo" == jo["externalIdSource"] and jo["externalId"]:
+        jufoids.append(jo["externalId"])
+  jufoids = sorted(set(jufoids))
+  if verbose>1: print("Get jufo data for %d journals"%(len(jufoids),))
+
+  def getone(jufoid):
+    # nb! jufo module stores data for later use
+    return jufo.get(jufoid,0,juforefresh)
+
+  # nb! snapshot first, API (or cache) only for channels missing from it
+  jufodata = {}
+  if not juforefresh:
+    jufodata = jufo.lookup(jufoids,verbose>1)
+    jufoids = [ jufoid for jufoid in jufoids if jufoid not in jufodata ]
 
-  return items
+  with ThreadPoolExecutor(max_workers=jufo.apischeduler.maxworkers) as executor:
+    jufodata.update(zip(jufoids, executor.map(getone, jufoids)))
+  return jufodata
 
-def parsemetrics(journaldata,verbose):
+def parsemetrics(journaldata,verbose,juforefresh=False):
   global metrics,metricstartyear,metricyears
 
   if verbose>1: print("Parse metrics from year %d to %d"%(metricstartyear,metricstartyear+metricyears,))
 
+  jufodata = {}
+  if "jufo" in metrics:
+    jufodata = getjufo(journaldata,verbose,juforefresh)
+
   metricdata = {}
   for jo in journaldata:
     if verbose>2: print("  >>> metrics from journal %s "%(jo["uuid"],))
     metric = {}
     metric["uuid"] = jo["uuid"] #redundant (dev/debug)
+    # scopusMetrics by year (in order)
+    scopusbyyear = {}
+    for a in jo.get("scopusMetrics", []):
+      scopusbyyear.setdefault(a["year"], []).append(a)
     for y in range(metricstartyear, metricstartyear+metricyears):
       for m in metrics:
         # jufo resides elsewhere
@@ -538,45 +952,385 @@ def parsemetrics(journaldata,verbose):
           if "externalIdSource" in jo and "externalId" in jo:
             if "jufo" == jo["externalIdSource"]:
               jufoid = jo["externalId"]
-              jufojson = jufo.get(jufoid)
-              # store if for later use
-              jufocfg = configparser.ConfigParser()
-              jufocfgsec = "LOCAL"
-              jufocfg.read('Jufo.cfg')
-              if not jufocfg.has_section(jufocfgsec):
-                print("Failed reading config. Exit")
-                exit(1)
-              # continue w/ [cfgsec] config
-              jufodatadir = jufocfg.get(jufocfgsec,"datadir") if jufocfg.has_option(jufocfgsec,"datadir") else "."
-              jufodatadir += "/"
-              with open(jufodatadir+"jufo_%s.json"%(jufoid,), "w") as f:
-                json.dump(jufojson, f)
-              for ju in jufojson: # should have only one
+              for ju in jufodata.get(jufoid) or []: # should have only one
                 if "Jufo_ID" in ju and "Jufo_%d"%(y,) in ju:
                   if jufoid == ju["Jufo_ID"]:
                     metric["Jufo metrics "+str(y)] = ju["Jufo_%d"%(y,)]
         else:
           if "scopusMetrics" in jo:
             if verbose>2: print("  >>> metrics from journal %s metrics %s"%(jo["uuid"],jo["scopusMetrics"],))
-            for a in jo["scopusMetrics"]:
-              if a["year"] == y:
-                if verbose>2: print("  >>> metrics from journal %s metric %s year %d data %s"%(jo["uuid"],m,y,a,))
-                if m in a:
-                  metric["Scopus metrics "+m+" "+str(y)] = a[m]
+            for a in scopusbyyear.get(y, []):
+              if verbose>2: print("  >>> metrics from journal %s metric %s year %d data %s"%(jo["uuid"],m,y,a,))
+              if m in a:
+                metric["Scopus metrics "+m+" "+str(y)] = a[m]
     if verbose>2: print("  >>> metrics from journal %s metric %s"%(jo["uuid"],metric,))
     metricdata[jo["uuid"]] = metric.copy()
   return metricdata
 
+# lookup indexes by uuid with only the values needed for rows
+def indexjournals(journaldata):
+  index = {}
+  for a in journaldata:
+    country = ""
+    if "country" in a:
+      country = js_value("term","text",a["country"])
+    index[a["uuid"]] = Journal(a["pureId"],jpart("workflow","workflowStep",a),country)
+  return index
+
+def indexpersons(persondata):
+  personsources = {
+    "/dk/atira/pure/person/personsources/employee": "employeeid",
+    "/dk/atira/pure/person/personsources/oodi": "oodiid",
+    "/dk/atira/pure/person/personsources/masterdb": "masterdbid",
+    "/dk/atira/pure/person/personsources/studentid": "studentid",
+  }
+  index = {}
+  for p in persondata:
+    ids = {"employeeid": "", "oodiid": "", "masterdbid": "", "studentid": ""}
+    # list of ids
+    if "ids" in p:
+      for i in p["ids"]:
+        if "type" in i:
+          if "uri" in i["type"]:
+            if i["type"]["uri"] in personsources:
+              ids[personsources[i["type"]["uri"]]] = jpart("value","value",i,memo=False)
+    index[p["uuid"]] = Person(p["pureId"],p["orcid"] if "orcid" in p else "",**ids)
+  return index
+
+def indexexternalpersons(externalpersondata):
+  return { p["uuid"]: ExternalPerson(p["pureId"]) for p in externalpersondata }
+
+def indexexternalorganisations(externalorganisationdata):
+  index = {}
+  for o in externalorganisationdata:
+    country = None # nb! None if not known, keep any earlier value
+    if "address" in o:
+      if "country" in o["address"]:
+        country = js_value("term","text",o["address"]["country"])
+    index[o["uuid"]] = ExternalOrganisation(country)
+  return index
+
+# intern repeated (short) string values while reading json
+def internhook(jsonobject):
+  global internlength
+  for k,v in jsonobject.items():
+    if type(v) is str and len(v) <= internlength:
+      jsonobject[k] = sys.intern(v)
+  return jsonobject
+
 def readjson(file,verbose):
   if verbose: print("Read JSON from '%s'"%(file,))
   jsondata = []
   with open(file, 'rb') as f:
-    rawjson = json.load(f)
+    rawjson = json.load(f, object_hook=internhook)
     if verbose>2: print("%s"%(rawjson,))
     jsondata = rawjson["items"]
       
   return jsondata
 
+# files of a source: a file, a directory of split page files from
+# get-pure.py (like "api-0001.json") or a glob pattern of such files.
+# nb! in order of page index
+# files of source (of kind, see pagenames): the file itself, files
+# matching a glob pattern or page files in a directory
+# nb! get-pure.py -S writes pages of all APIs side by side, so from a
+#     directory only pages named after the source are read
+def sourcefiles(source,kind):
+  global pagenames
+  if os.path.isdir(source):
+    files = glob.glob(os.path.join(glob.escape(source),glob.escape(pagenames[kind])+"-[0-9][0-9][0-9][0-9]*.json"))
+  elif re.search(r"[*?[]", source):
+    files = glob.glob(source)
+  else:
+    return [source]
+  def pageindex(file):
+    m = re.search(r"^(.*?)(\d+)\.json$", file)
+    return (m.group(1),int(m.group(2))) if m else (file,0)
+  return sorted(files, key=pageindex)
+
+# read all files of source, split page files in parallel
+# nb! pages are read in this process one by one: passing decoded pages
+#     back from worker processes costs more than decoding them (and
+#     strings would not be interned across pages)
+def readsource(source,kind,verbose):
+  files = sourcefiles(source,kind)
+  if not files: exit("No files for %s. Exit."%(source,))
+  jsondata = []
+  for file in files:
+    jsondata += readjson(file,verbose)
+  return jsondata
+
+def initpages(config,context):
+  global keywords,metrics,metricstartyear,metricyears,pagecontext
+  (keywords,metrics,metricstartyear,metricyears) = config
+  pagecontext = context
+
+def parsepage(file):
+  global pagecontext
+  (filters,metricdata,journals,persons,externalpersons,externalorganisations,verbose) = pagecontext
+  jsondata = selectrecords(readjson(file,verbose),filters,verbose)
+  return list(parsejson(jsondata,metricdata,journals,persons,externalpersons,externalorganisations,verbose))
+
+# parse research output pages in worker processes, rows in order of pages
+def parsepages(files,filters,metricdata,journals,persons,externalpersons,externalorganisations,verbose,workers):
+  global keywords,metrics,metricstartyear,metricyears
+  config = (keywords,metrics,metricstartyear,metricyears)
+  context = (filters,metricdata,journals,persons,externalpersons,externalorganisations,verbose)
+  with Pool(workers, initpages, (config,context)) as pool:
+    for rows in pool.imap(parsepage, files):
+      for row in rows:
+        yield row
+
+# year of research output as in column "Research output status year"
+def recordyear(j):
+  year = None
+  if "publicationStatuses" in j:
+    for a in j["publicationStatuses"]:
+      year = a["publicationDate"]["year"]
+  return year
+
+# year filter like "2019" or "2015-2019" to (from,to)
+def parseyears(value):
+  m = re.search(r"^\s*(\d{4})\s*(?:-\s*(\d{4})\s*)?$", value)
+  if not m: raise ValueError("Bad year (range): %s"%(value,))
+  return (int(m.group(1)),int(m.group(2) or m.group(1)))
+
+# names of filters (options and query parameters)
+filternames = ["year","org","type","subtype","assessment","workflow"]
+
+def addfilter(filters,name,value):
+  if name == "year":
+    filters["year"] = parseyears(value)
+  else:
+    filters.setdefault(name, set()).add(value)
+
+# test research output (raw json) against filters before anything else
+# is done with it. filters (all must match):
+# "year"       (from,to) of "Research output status year"
+# "org"        set of managing organisational unit uuids
+# "type"       set of types (like "contributiontojournal")
+# "subtype"    set of subtypes (like "article")
+# "assessment" set of assessment type categories or codes (like "A" or "A1")
+# "workflow"   set of workflow steps (like "approved")
+def selectrecord(j,filters):
+  if "year" in filters:
+    year = recordyear(j)
+    if year is None or not filters["year"][0] <= year <= filters["year"][1]:
+      return False
+  if "org" in filters:
+    if "managingOrganisationalUnit" not in j: return False
+    if j["managingOrganisationalUnit"]["uuid"] not in filters["org"]: return False
+  if "type" in filters or "subtype" in filters:
+    typeuri = [None,None]
+    if "type" in j and "uri" in j["type"]:
+      typeuri = j["type"]["uri"].split("/")
+    if "type" in filters and typeuri[-2] not in filters["type"]: return False
+    if "subtype" in filters and typeuri[-1] not in filters["subtype"]: return False
+  if "assessment" in filters:
+    code = jpart("assessmentType","uri",j)
+    if not code: return False
+    if not any(code.startswith(a) for a in filters["assessment"]): return False
+  if "workflow" in filters:
+    if jpart("workflow","workflowStep",j) not in filters["workflow"]: return False
+  return True
+
+def selectrecords(jsondata,filters,verbose):
+  if not filters: return jsondata
+  selected = [ j for j in jsondata if selectrecord(j,filters) ]
+  if verbose>1: print("Selected %d of %d research outputs"%(len(selected),len(jsondata),))
+  return selected
+
+# uuids of journals, persons and organisations referenced from research
+# outputs (raw json), so that only those need metrics (JUFO) and lookups
+def references(jsondata,wanted=None):
+  if wanted is None:
+    wanted = {"journals": set(), "persons": set(), "externalpersons": set(), "externalorganisations": set()}
+  for j in jsondata:
+    if "journalAssociation" in j and "journal" in j["journalAssociation"]:
+      if "uuid" in j["journalAssociation"]["journal"]:
+        wanted["journals"].add(j["journalAssociation"]["journal"]["uuid"])
+    for a in j.get("personAssociations", []):
+      if "person" in a:
+        wanted["persons"].add(a["person"]["uuid"])
+      if "externalPerson" in a:
+        wanted["externalpersons"].add(a["externalPerson"]["uuid"])
+      for b in a.get("externalOrganisations", []):
+        wanted["externalorganisations"].add(b["uuid"])
+  return wanted
+
+def pagereferences(file):
+  global pagecontext
+  (filters,verbose) = pagecontext
+  return references(selectrecords(readjson(file,verbose),filters,verbose))
+
+# references of selected research outputs in page files, read by workers
+def selectedreferences(files,filters,verbose,workers):
+  global keywords,metrics,metricstartyear,metricyears
+  config = (keywords,metrics,metricstartyear,metricyears)
+  wanted = None
+  with Pool(workers, initpages, (config,(filters,verbose))) as pool:
+    for pagewanted in pool.imap(pagereferences, files):
+      if wanted is None:
+        wanted = pagewanted
+      else:
+        for name in wanted:
+          wanted[name] |= pagewanted[name]
+  return wanted
+
+# items of a source referenced from selected research outputs (all without filters)
+def referenced(jsondata,wanted,name):
+  if wanted is None: return jsondata
+  return [ a for a in jsondata if a["uuid"] in wanted[name] ]
+
+# Serve mode: keep data in memory and make CSV exports on request
+#
+# warm holds for every source file (by kind) its modification time and
+# what was built from it: raw items of research outputs but only index
+# (and metrics) of journals, persons and organisations, like in a batch
+# run. Only changed files are read again and merged data of a source is
+# rebuilt only when some of its files changed.
+def readwarm(warm,source,kind,build,verbose):
+  files = sourcefiles(source,kind)
+  if not files: raise IOError("No files for %s"%(source,))
+  warmfiles = warm.setdefault("files", {})
+  warmsources = warm.setdefault("sources", {})
+  changed = False
+  built = []
+  for file in files:
+    filestat = os.stat(file)
+    stamp = (filestat.st_mtime,filestat.st_size)
+    if (kind,file) not in warmfiles or warmfiles[(kind,file)][0] != stamp:
+      warmfiles[(kind,file)] = (stamp,build(readjson(file,verbose)))
+      changed = True
+    built.append(warmfiles[(kind,file)][1])
+  if warmsources.get(kind) != files: # files added or removed
+    warmsources[kind] = files
+    changed = True
+  return (built,changed)
+
+# indexes of page files merged to one (later pages win like in one file)
+def mergeindexes(indexes):
+  if len(indexes) == 1: return indexes[0]
+  merged = {}
+  for index in indexes:
+    merged.update(index)
+  return merged
+
+def loadwarm(warm,sources,verbose,juforefresh=False):
+  (researchfile,journalfile,personfile,externalpersonfile,externalorganisationfile) = sources
+  (built,changed) = readwarm(warm,researchfile,"research",lambda jsondata: jsondata,verbose)
+  if changed or "research" not in warm:
+    warm["research"] = [ j for page in built for j in page ]
+  (built,changed) = readwarm(warm,journalfile,"journal",lambda jsondata: (indexjournals(jsondata),parsemetrics(jsondata,verbose,juforefresh)),verbose)
+  if changed or "journals" not in warm:
+    warm["journals"] = mergeindexes([ journals for (journals,metricdata) in built ])
+    warm["metrics"] = mergeindexes([ metricdata for (journals,metricdata) in built ])
+  (built,changed) = readwarm(warm,personfile,"person",indexpersons,verbose)
+  if changed or "persons" not in warm:
+    warm["persons"] = mergeindexes(built)
+  (built,changed) = readwarm(warm,externalpersonfile,"externalperson",indexexternalpersons,verbose)
+  if changed or "externalpersons" not in warm:
+    warm["externalpersons"] = mergeindexes(built)
+  (built,changed) = readwarm(warm,externalorganisationfile,"externalorganisation",indexexternalorganisations,verbose)
+  if changed or "externalorganisations" not in warm:
+    warm["externalorganisations"] = mergeindexes(built)
+  # forget files that are not part of any source anymore (e.g. rotated pages)
+  current = set((kind,file) for (kind,files) in warm["sources"].items() for file in files)
+  for key in list(warm["files"]):
+    if key not in current:
+      del warm["files"][key]
+  # nb! a consistent set of data for one export
+  return (warm["research"],warm["metrics"],warm["journals"],warm["persons"],warm["externalpersons"],warm["externalorganisations"])
+
+class ExportServer(socketserver.ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+
+class UnixExportServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+  daemon_threads = True
+
+class ExportHandler(BaseHTTPRequestHandler):
+  """
+  GET /export[?year=<year>[-<year>]][&org=<uuid>][&type=<type>]...
+
+  Responds with CSV like the output file, with only the research
+  outputs matching all given filters (see filternames). Changed
+  source files are read again before the export.
+  """
+  def address_string(self):
+    return self.client_address[0] if self.client_address else "unix"
+
+  def log_message(self, format, *args):
+    if self.server.verbose>1: BaseHTTPRequestHandler.log_message(self, format, *args)
+
+  def do_GET(self):
+    url = urlsplit(self.path)
+    if url.path != "/export":
+      self.send_error(404)
+      return
+    try:
+      filters = self.filters(parse_qs(url.query))
+    except ValueError as e:
+      self.send_error(400, str(e))
+      return
+    verbose = self.server.verbose
+    try:
+      with self.server.lock:
+        data = loadwarm(self.server.warm,self.server.sources,verbose)
+    except (IOError, ValueError) as e:
+      self.send_error(500, str(e))
+      return
+    (jsondata,metricdata,journals,persons,externalpersons,externalorganisations) = data
+    jsondata = selectrecords(jsondata,filters,verbose)
+    # nb! rows are made while they are sent, not all before the first byte
+    items = parsejson(jsondata,metricdata,journals,persons,externalpersons,externalorganisations,verbose)
+
+    self.send_response(200)
+    self.send_header("Content-Type", "text/csv; charset=UTF-8")
+    self.end_headers()
+    f = io.TextIOWrapper(self.wfile, encoding="UTF-8", newline='', write_through=True)
+    count = writecsvfile(f,self.path,makerow(verbose),items,verbose)
+    f.detach()
+    if verbose: print("Export %s with %d rows"%(self.path,count,))
+
+  def filters(self, query):
+    filters = {}
+    for name in filternames:
+      for value in query.get(name, []):
+        addfilter(filters,name,value)
+    return filters
+
+def issocket(path):
+  return os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode)
+
+# address is either "host:port" or path of a Unix socket (with a "/",
+# e.g. "./make-csv.sock", so that a mistyped host is not taken for a path)
+def serve(address,sources,verbose,juforefresh=False):
+  if ":" in address:
+    (host,port) = address.rsplit(":", 1)
+    server = ExportServer((host,int(port)), ExportHandler)
+  else:
+    if "/" not in address: exit("Address must be <host>:<port> or path of Unix socket like ./%s. Exit."%(address,))
+    if os.path.exists(address):
+      # nb! only a socket left over from earlier run is removed, never a file
+      if not issocket(address): exit("File %s exists and is not a socket. Exit."%(address,))
+      os.unlink(address)
+    server = UnixExportServer(address, ExportHandler)
+  server.verbose = verbose
+  server.sources = sources
+  server.warm = {}
+  server.lock = threading.Lock()
+  loadwarm(server.warm,sources,verbose,juforefresh)
+  if verbose: print("Serving exports at %s"%(address,))
+  # stop cleanly on kill (SIGTERM) as well as on Ctrl-C
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+    if ":" not in address and issocket(address): os.unlink(address)
+
 def usage():
   print("""usage: make-csv.py [OPTIONS]
 
@@ -589,16 +1343,59 @@ Source files with defaults from configuration:
 -p, --person <file>
 -e, --externalperson <file>
 -o, --externalorganisation <file>
+Each source may also be a directory or a quoted glob pattern
+("research-outputs-*.json") of split page files from get-pure.py -S.
+Research output pages are read and parsed by parallel workers.
 
 Output file with default from configuration:
 -O, --output <file>
 
+Sharded output (instead of one output file):
+-b, --shard-by <column> : one file per value of column
+                          e.g. "Research output status year"
+-n, --shard-size <rows> : max number of rows per file
+
+Delta output (beside full output):
+-P, --previous <file> : previous export (CSV file) or its fingerprint
+                        index ("<output>-fingerprints.csv") to compare to
+                        writes "<output>-added.csv", "<output>-changed.csv",
+                        "<output>-removed.csv" and new fingerprint index
+
+SQLite output (instead of output file):
+-d, --database <file> : write rows to SQLite database, research output
+                        and person columns in tables of their own and
+                        view "export" with the rows and columns of CSV
+
+-w, --workers <n>   : number of parallel workers for research output pages
+                      and sharded output, defaults to 4
+
+-J, --jufo-refresh  : revalidate cached JUFO data from API
+                      (unchanged data is not downloaded again)
+
+Filters (research outputs are selected before anything else is done,
+options other than year may be repeated, all filters must match):
+-y, --year <year>[-<year>] : research output status year (range)
+-u, --org <uuid>           : managing organisational unit UUID
+-t, --type <type>          : type, like "contributiontojournal"
+-s, --subtype <subtype>    : subtype, like "article"
+-a, --assessment <code>    : assessment type category or code, like "A" or "A1"
+-W, --workflow <step>      : workflow step, like "approved"
+
+-M, --metrics <file>: write metrics of the run to <file> in Prometheus
+                      text format (for node_exporter textfile collector)
+
+-D, --serve <address> : keep running and serve CSV exports over HTTP
+                        at "<host>:<port>" or at Unix socket <path>
+                        (with a "/", e.g. "./make-csv.sock")
+                        GET /export?year=<year>[-<year>]&org=<uuid>...
+                        (query parameters like filter options above)
+
 -v, --verbose       : increase verbosity
 -q, --quiet         : reduce verbosity
 """)
 
 def main(argv):
-  global keywords,metrics,metricstartyear,metricyears
+  global keywords,metrics,metricstartyear,metricyears,pagenames
 
   cfgsec = "CSV"
   cfg = configparser.ConfigParser()
@@ -616,6 +1413,20 @@ def main(argv):
   externalpersonfile = cfg.get(cfgsec,"externalpersonfile") if cfg.has_option(cfgsec,"externalpersonfile") else None
   externalorganisationfile = cfg.get(cfgsec,"externalorganisationfile") if cfg.has_option(cfgsec,"externalorganisationfile") else None
   outputfile = cfg.get(cfgsec,"outputfile") if cfg.has_option(cfgsec,"outputfile") else None
+  # page files in a directory are named after configured source files
+  for kind in pagenames:
+    if cfg.has_option(cfgsec,kind+"file"):
+      pagenames[kind] = os.path.splitext(os.path.basename(cfg.get(cfgsec,kind+"file")))[0]
+  shardby = None
+  shardsize = None
+  workers = 4
+  juforefresh = False
+  serveaddress = None
+  filters = {}
+  yearfilter = None
+  previousfile = None
+  metricsfile = None
+  dbfile = None
 
   if cfg.has_option(cfgsec,"keywords"):
     keywords = json.loads(cfg.get(cfgsec,"keywords"))
@@ -628,7 +1439,7 @@ def main(argv):
 
   # read possible arguments. all optional given that defaults suffice
   try:
-    opts, args = getopt.getopt(argv,"hr:j:p:e:o:O:vq",["help","research=","journal=","person=","externalperson=","externalorganisation=","output=","verbose","quiet"])
+    opts, args = getopt.getopt(argv,"hr:j:p:e:o:O:d:b:n:w:JD:y:u:t:s:a:W:P:M:vq",["help","research=","journal=","person=","externalperson=","externalorganisation=","output=","database=","shard-by=","shard-size=","workers=","jufo-refresh","serve=","year=","org=","type=","subtype=","assessment=","workflow=","previous=","metrics=","verbose","quiet"])
   except getopt.GetoptError as err:
     print(err)
     sys.exit(2)
@@ -642,6 +1453,20 @@ def main(argv):
     elif opt in ("-e", "--externalperson"): externalpersonfile = arg
     elif opt in ("-o", "--externalorganisation"): externalorganisationfile = arg
     elif opt in ("-O", "--output"): outputfile = arg
+    elif opt in ("-d", "--database"): dbfile = arg
+    elif opt in ("-b", "--shard-by"): shardby = arg
+    elif opt in ("-n", "--shard-size"): shardsize = int(arg)
+    elif opt in ("-w", "--workers"): workers = int(arg)
+    elif opt in ("-J", "--jufo-refresh"): juforefresh = True
+    elif opt in ("-D", "--serve"): serveaddress = arg
+    elif opt in ("-y", "--year"): yearfilter = arg
+    elif opt in ("-u", "--org"): addfilter(filters,"org",arg)
+    elif opt in ("-t", "--type"): addfilter(filters,"type",arg)
+    elif opt in ("-s", "--subtype"): addfilter(filters,"subtype",arg)
+    elif opt in ("-a", "--assessment"): addfilter(filters,"assessment",arg)
+    elif opt in ("-W", "--workflow"): addfilter(filters,"workflow",arg)
+    elif opt in ("-P", "--previous"): previousfile = arg
+    elif opt in ("-M", "--metrics"): metricsfile = arg
     elif opt in ("-v", "--verbose"): verbose += 1
     elif opt in ("-q", "--quiet"): verbose -= 1
 
@@ -649,17 +1474,65 @@ def main(argv):
   if not journalfile: exit("No journal file. Exit.")
   if not personfile: exit("No person file. Exit.")
   if not externalpersonfile: exit("No externalperson file. Exit.")
-  if not outputfile: exit("No output file. Exit.")
+  if not outputfile and (not dbfile or previousfile): exit("No output file. Exit.")
+  if dbfile and (shardby or shardsize): exit("Sharded output is for CSV only. Exit.")
+  if shardby and shardby not in makerow(verbose): exit("No such column to shard by: %s. Exit."%(shardby,))
+  if shardsize is not None and shardsize < 1: exit("Shard size must be positive. Exit.")
+  if workers < 1: exit("Workers must be positive. Exit.")
+  if previousfile and not os.path.exists(previousfile): exit("No previous file %s. Exit."%(previousfile,))
+  if yearfilter:
+    try:
+      addfilter(filters,"year",yearfilter)
+    except ValueError as e:
+      exit("%s. Exit."%(e,))
+
+  if serveaddress:
+    sources = (researchfile,journalfile,personfile,externalpersonfile,externalorganisationfile)
+    serve(serveaddress,sources,verbose,juforefresh)
+    return
+
+  start = monotonic()
+  researchfiles = sourcefiles(researchfile,"research")
+  if not researchfiles: exit("No files for %s. Exit."%(researchfile,))
+  jsondata = None
+  wanted = None # with filters: uuids referenced from selected research outputs
+  with prommetrics.stage("read", script="make-csv"):
+    # nb! research outputs are selected first so that only their journals
+    #     get metrics (JUFO calls) and only their persons are indexed
+    if len(researchfiles) == 1:
+      jsondata = selectrecords(readjson(researchfiles[0],verbose),filters,verbose)
+      if filters: wanted = references(jsondata)
+    elif filters:
+      wanted = selectedreferences(researchfiles,filters,verbose,workers)
+    journaldata = referenced(readsource(journalfile,"journal",verbose),wanted,"journals")
+    # nb! only compact lookup records are kept from persons and organisations
+    persons = indexpersons(referenced(readsource(personfile,"person",verbose),wanted,"persons"))
+    externalpersons = indexexternalpersons(referenced(readsource(externalpersonfile,"externalperson",verbose),wanted,"externalpersons"))
+    externalorganisations = indexexternalorganisations(referenced(readsource(externalorganisationfile,"externalorganisation",verbose),wanted,"externalorganisations"))
+    if verbose>1: print("Indexed %d persons, %d external persons and %d external organisations"%(len(persons),len(externalpersons),len(externalorganisations),))
 
-  jsondata = readjson(researchfile,verbose)
-  journaldata = readjson(journalfile,verbose)
-  persondata = readjson(personfile,verbose)
-  externalpersondata = readjson(externalpersonfile,verbose)
-  externalorganisationdata = readjson(externalorganisationfile,verbose)
+  with prommetrics.stage("metrics", script="make-csv"):
+    metricdata = parsemetrics(journaldata,verbose,juforefresh)
+    journals = indexjournals(journaldata)
+  if len(researchfiles) > 1:
+    # nb! pages are parsed while output is written
+    items = parsepages(researchfiles,filters,metricdata,journals,persons,externalpersons,externalorganisations,verbose,workers)
+  else:
+    with prommetrics.stage("parse", script="make-csv"):
+      items = list(parsejson(jsondata,metricdata,journals,persons,externalpersons,externalorganisations,verbose))
+  delta = None
+  if previousfile:
+    delta = Delta(previousfile,outputfile,makerow(verbose),verbose)
+  with prommetrics.stage("write", script="make-csv"):
+    count = output(outputfile,items,verbose,shardby,shardsize,workers,delta,dbfile)
 
-  metricdata = parsemetrics(journaldata,verbose)
-  items = parsejson(jsondata,metricdata,journaldata,persondata,externalpersondata,externalorganisationdata,verbose)
-  output(outputfile,items,verbose)
+  memostats(verbose)
+  duration = monotonic()-start
+  prommetrics.setgauge("pure_stage_duration_seconds", duration, stage="total", script="make-csv")
+  prommetrics.inc("pure_csv_rows_written_total", count)
+  prommetrics.setgauge("pure_csv_rows_per_second", count/duration if duration else 0)
+  if metricsfile:
+    prommetrics.write(metricsfile, script="make-csv")
   
 if __name__ == "__main__":
   main(sys.argv[1:])
@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=UTF-8 :
+"""
+prommetrics
+
+Module to collect counters, gauges and histograms of a run and write
+them to a file in Prometheus text format, e.g. for node_exporter's
+textfile collector.
+
+Use as a module with:
+  prommetrics.inc("pure_pages_fetched_total", api="persons")
+  prommetrics.observe("pure_http_request_duration_seconds", 0.3, status="200")
+  with prommetrics.stage("read", script="make-csv"): ...
+  prommetrics.write("/path/to/textfile/dir/make-csv.prom")
+
+Collecting is always on (and cheap), nothing is written unless asked.
+"""
+import os
+import threading
+from time import time, monotonic
+from contextlib import contextmanager
+
+# upper bounds of histogram buckets (seconds)
+buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# help texts and types of known metrics
+described = {
+  "pure_http_request_duration_seconds": ("histogram", "Latency of HTTP requests to APIs by host and status"),
+  "pure_http_retries_total": ("counter", "HTTP requests retried after throttling or errors by host"),
+  "pure_pages_fetched_total": ("counter", "Pages fetched from Pure API"),
+  "pure_items_fetched_total": ("counter", "Items fetched from Pure API"),
+  "pure_bytes_downloaded_total": ("counter", "Bytes downloaded from Pure API"),
+  "pure_jufo_cache_total": ("counter", "JUFO lookups by result (hit, miss, revalidated, stale, snapshot)"),
+  "pure_csv_rows_written_total": ("counter", "Rows written to CSV output"),
+  "pure_csv_rows_per_second": ("gauge", "Rows written to CSV output per second"),
+  "pure_stage_duration_seconds": ("gauge", "Duration of stages of the run"),
+  "pure_memo_lookups": ("gauge", "Lookups of memoized transforms by table and result (hit, miss)"),
+  "pure_last_run_timestamp_seconds": ("gauge", "Time when the run ended"),
+}
+
+lock = threading.Lock()
+values = {} # name => { labels (sorted tuple) => value or histogram [bucket counts..., sum, count] }
+
+def labelkey(labels):
+  return tuple(sorted((k,str(v)) for k,v in labels.items()))
+
+def inc(name, value=1, **labels):
+  key = labelkey(labels)
+  with lock:
+    metric = values.setdefault(name, {})
+    metric[key] = metric.get(key, 0) + value
+
+def setgauge(name, value, **labels):
+  key = labelkey(labels)
+  with lock:
+    values.setdefault(name, {})[key] = value
+
+def observe(name, value, **labels):
+  key = labelkey(labels)
+  with lock:
+    metric = values.setdefault(name, {})
+    if key not in metric:
+      metric[key] = [0]*len(buckets) + [0.0, 0]
+    h = metric[key]
+    for i,le in enumerate(buckets):
+      if value <= le: h[i] += 1
+    h[-2] += value
+    h[-1] += 1
+
+@contextmanager
+def stage(name, **labels):
+  start = monotonic()
+  try:
+    yield
+  finally:
+    setgauge("pure_stage_duration_seconds", monotonic()-start, stage=name, **labels)
+
+def formatlabels(key, extra=()):
+  labels = list(key)+list(extra)
+  if not labels: return ""
+  return "{"+",".join('%s="%s"'%(k,v.replace("\\","\\\\").replace('"','\\"').replace("\n","\\n")) for k,v in labels)+"}"
+
+def formatvalue(value):
+  return repr(float(value)) if isinstance(value, float) else str(value)
+
+# write all metrics to file (atomically, so a collector never sees half a file)
+def write(file, **labels):
+  setgauge("pure_last_run_timestamp_seconds", time(), **labels)
+  lines = []
+  with lock:
+    for name in sorted(values):
+      (kind,text) = described.get(name, ("untyped", name))
+      lines.append("# HELP %s %s"%(name,text,))
+      lines.append("# TYPE %s %s"%(name,kind,))
+      for key in sorted(values[name]):
+        value = values[name][key]
+        if kind == "histogram":
+          for i,le in enumerate(buckets):
+            lines.append("%s_bucket%s %d"%(name,formatlabels(key,[("le",str(le))]),value[i],))
+          lines.append("%s_bucket%s %d"%(name,formatlabels(key,[("le","+Inf")]),value[-1],))
+          lines.append("%s_sum%s %s"%(name,formatlabels(key),formatvalue(value[-2]),))
+          lines.append("%s_count%s %d"%(name,formatlabels(key),value[-1],))
+        else:
+          lines.append("%s%s %s"%(name,formatlabels(key),formatvalue(value),))
+  with open(file+".tmp", "w") as f:
+    f.write("\n".join(lines)+"\n")
+  os.replace(file+".tmp", file)
@@ -0,0 +1,155 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=UTF-8 :
+"""
+scheduler
+
+Module to pace HTTP calls to APIs (Pure, JUFO).
+
+Every host gets its own
+- ceiling of requests per second (ratelimit, 0 for no ceiling)
+- limit of requests in flight, adjusted AIMD-style between 1 and
+  maxworkers: one more for every "limit" successful calls and halved
+  on throttling (429), server errors, network errors and when latency
+  gets much worse than the best seen so far
+- pause when the API answers with a Retry-After header
+
+Throttled and failed calls are retried with backoff. Any URL works,
+so a local HTTP server (http://localhost:8000/...) simulating
+throttling can stand in for the real API.
+
+Use as a module with:
+  s = scheduler.Scheduler(ratelimit,maxworkers)
+  r = s.get(url, headers=..., auth=...)
+"""
+import time
+import threading
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+import requests
+import prommetrics
+
+# status codes that mean "slow down" and are retried
+retrystatus = (429, 502, 503, 504)
+
+class Host:
+  def __init__(self, ratelimit, maxworkers):
+    self.ratelimit = ratelimit
+    self.maxworkers = maxworkers
+    self.limit = 1.0 # requests in flight allowed, start slow
+    self.inflight = 0
+    self.nextcall = 0.0 # time.monotonic() when next call may start
+    self.baseline = None # best latency seen
+    self.cond = threading.Condition()
+
+class Scheduler:
+  def __init__(self, ratelimit=0, maxworkers=4, retries=5, backoff=1.0, timeout=60, slowfactor=3.0, verbose=0):
+    self.ratelimit = ratelimit
+    self.maxworkers = max(1, maxworkers)
+    self.retries = retries
+    self.backoff = backoff
+    self.timeout = timeout
+    self.slowfactor = slowfactor
+    self.verbose = verbose
+    self.hosts = {}
+    self.lock = threading.Lock()
+    # statistics
+    self.calls = 0
+    self.retried = 0
+
+  def host(self, url):
+    netloc = urlsplit(url).netloc
+    with self.lock:
+      if netloc not in self.hosts:
+        self.hosts[netloc] = Host(self.ratelimit, self.maxworkers)
+      return self.hosts[netloc]
+
+  def acquire(self, h):
+    with h.cond:
+      while h.inflight >= int(h.limit):
+        h.cond.wait()
+      h.inflight += 1
+      now = time.monotonic()
+      wait = h.nextcall - now
+      h.nextcall = max(now, h.nextcall) + (1.0/h.ratelimit if h.ratelimit else 0.0)
+    if wait > 0:
+      time.sleep(wait)
+
+  def release(self, h, latency, ok):
+    with h.cond:
+      h.inflight -= 1
+      if ok and (h.baseline is None or latency < h.baseline):
+        h.baseline = latency
+      if ok and latency <= h.baseline*self.slowfactor:
+        h.limit = min(float(h.maxworkers), h.limit + 1.0/h.limit) # additive increase
+      else:
+        h.limit = max(1.0, h.limit/2) # multiplicative decrease
+      h.cond.notify_all()
+
+  def pause(self, h, seconds):
+    with h.cond:
+      h.nextcall = max(h.nextcall, time.monotonic()+seconds)
+
+  def request(self, method, url, **kwargs):
+    h = self.host(url)
+    kwargs.setdefault("timeout", self.timeout)
+    attempt = 0
+    while True:
+      self.acquire(h)
+      start = time.monotonic()
+      try:
+        with self.lock: self.calls += 1
+        r = requests.request(method, url, **kwargs)
+      except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+        self.release(h, time.monotonic()-start, False)
+        prommetrics.observe("pure_http_request_duration_seconds", time.monotonic()-start, host=urlsplit(url).netloc, status="error")
+        attempt += 1
+        if attempt > self.retries:
+          raise
+        with self.lock: self.retried += 1
+        prommetrics.inc("pure_http_retries_total", host=urlsplit(url).netloc)
+        time.sleep(self.backoff * 2**(attempt-1))
+        continue
+      except Exception:
+        self.release(h, time.monotonic()-start, False)
+        raise
+      latency = time.monotonic()-start
+      prommetrics.observe("pure_http_request_duration_seconds", latency, host=urlsplit(url).netloc, status=str(r.status_code))
+      if r.status_code not in retrystatus:
+        self.release(h, latency, True)
+        return r
+      self.release(h, latency, False)
+      attempt += 1
+      if attempt > self.retries:
+        return r
+      delay = retryafter(r)
+      if delay is None:
+        delay = self.backoff * 2**(attempt-1)
+      if self.verbose: show("HTTP status %d from %s, retry in %.1f s"%(r.status_code,urlsplit(url).netloc,delay,))
+      r.close()
+      with self.lock: self.retried += 1
+      prommetrics.inc("pure_http_retries_total", host=urlsplit(url).netloc)
+      self.pause(h, delay)
+
+  def get(self, url, **kwargs):
+    return self.request("GET", url, **kwargs)
+
+  def post(self, url, **kwargs):
+    return self.request("POST", url, **kwargs)
+
+def show(message):
+  print(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())+" "+message)
+
+# seconds to wait from Retry-After header (either seconds or HTTP-date)
+def retryafter(r):
+  value = r.headers.get("Retry-After")
+  if not value:
+    return None
+  try:
+    return max(0.0, float(value))
+  except ValueError:
+    pass
+  try:
+    return max(0.0, parsedate_to_datetime(value).timestamp()-time.time())
+  except (TypeError, ValueError):
+    return None
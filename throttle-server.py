@@ -0,0 +1,193 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=UTF-8 :
+"""
+throttle-server
+
+Local stand-in for Pure and JUFO APIs that throttles like a busy API,
+to try out scheduler.py (and get-pure.py, jufo.py, make-csv.py) without
+touching the real thing. Point the scripts to it with values
+  hostname: localhost:8000
+  scheme: http
+in section [API] of Pure.cfg or Jufo.cfg.
+
+Answers
+- 429 with Retry-After when there are more than <ratelimit> calls in a second
+- 503 to a given share of calls (errors)
+- GET <uri>/<api>?size=<n>&offset=<n> with a page of items from data
+  file (JSON {"items":[...]} like get-pure.py writes) with
+  navigationLinks to next page, like Pure API
+- POST <uri>/<api> with {"uuids":[...]} with items of those uuids
+- GET <uri>/<code> without data file with a JUFO channel:
+  [{"Jufo_ID":"<code>","Jufo_<year>":"1"}]
+"""
+import sys, getopt
+import json
+import random
+import signal
+import threading
+import socketserver
+from collections import deque
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlsplit, parse_qs
+from time import localtime, strftime, monotonic, sleep
+
+def show(message):
+  print(strftime("%Y-%m-%d %H:%M:%S", localtime())+" "+message)
+
+class ThrottleServer(socketserver.ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+
+class ThrottleHandler(BaseHTTPRequestHandler):
+  # seconds to wait (Retry-After) or None if call may pass
+  def throttle(self):
+    server = self.server
+    with server.lock:
+      server.calls += 1
+      now = monotonic()
+      while server.recent and server.recent[0] <= now-1.0:
+        server.recent.popleft()
+      if server.ratelimit and len(server.recent) >= server.ratelimit:
+        server.throttled += 1
+        return max(1, int(server.recent[0]+1.0-now+0.999))
+      server.recent.append(now)
+    return None
+
+  def respond(self, status, data=None, headers={}):
+    body = json.dumps(data).encode("utf-8") if data is not None else b""
+    self.send_response(status)
+    for (k,v) in headers.items():
+      self.send_header(k, v)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def call(self, query):
+    server = self.server
+    wait = self.throttle()
+    if wait is not None:
+      if server.verbose>1: show("429 %s %s"%(self.command,self.path,))
+      self.respond(429, {"error": "too many requests"}, {"Retry-After": str(wait)})
+      return
+    if server.latency: sleep(server.latency)
+    if random.random() < server.errors:
+      with server.lock: server.failed += 1
+      if server.verbose>1: show("503 %s %s"%(self.command,self.path,))
+      self.respond(503, {"error": "unavailable"})
+      return
+    if server.verbose>1: show("200 %s %s"%(self.command,self.path,))
+    url = urlsplit(self.path)
+    if server.items is None:
+      # JUFO channel
+      code = url.path.rsplit("/", 1)[-1]
+      self.respond(200, [{"Jufo_ID": code, "Jufo_2019": "1", "Jufo_2020": "1"}])
+      return
+    if query is not None:
+      uuids = set(query.get("uuids", []))
+      items = [ j for j in server.items if j.get("uuid") in uuids ]
+      self.respond(200, {"count": len(items), "items": items})
+      return
+    params = parse_qs(url.query)
+    offset = int(params.get("offset", ["0"])[0])
+    size = int(params.get("size", ["10"])[0])
+    page = {"count": len(server.items), "pageInformation": {"offset": offset, "size": size}, "items": server.items[offset:offset+size]}
+    if offset+size < len(server.items):
+      href = "http://%s%s?navigationLink=true&size=%d&offset=%d"%(self.headers.get("Host"),url.path,size,offset+size,)
+      page["navigationLinks"] = [{"ref": "next", "href": href}]
+    self.respond(200, page)
+
+  def do_GET(self):
+    self.call(None)
+
+  def do_POST(self):
+    length = int(self.headers.get("Content-Length") or 0)
+    try:
+      query = json.loads(self.rfile.read(length) or b"{}")
+    except ValueError:
+      self.respond(400, {"error": "bad request"})
+      return
+    self.call(query)
+
+  def log_message(self, format, *args):
+    pass
+
+def usage():
+  print("""usage: throttle-server.py [OPTIONS]
+
+OPTIONS
+-h, --help            : this message and exit
+-a, --address <addr>  : "<host>:<port>" to listen at
+                        defaults to localhost:8000
+-d, --data <file>     : JSON file with items to serve like Pure API
+                        (e.g. research-outputs.json from get-pure.py)
+                        without it serves JUFO channels
+-r, --ratelimit <n>   : calls per second before answering 429
+                        with Retry-After, 0 for no ceiling
+                        defaults to 2
+-e, --errors <share>  : share of calls answered 503, e.g. 0.1
+                        defaults to 0
+-l, --latency <secs>  : seconds added to every call
+                        defaults to 0
+-v, --verbose         : increase verbosity (every call with -v -v)
+-q, --quiet           : reduce verbosity
+
+Stop with Ctrl-C or kill.
+""")
+
+def main(argv):
+  # variables from arguments with possible defaults
+  address = "localhost:8000"
+  datafile = None
+  ratelimit = 2
+  errors = 0.0
+  latency = 0.0
+  verbose = 1 # default minor messages
+
+  try:
+    opts, args = getopt.getopt(argv,"ha:d:r:e:l:vq",["help","address=","data=","ratelimit=","errors=","latency=","verbose","quiet"])
+  except getopt.GetoptError as err:
+    print(err)
+    usage()
+    sys.exit(2)
+  for opt, arg in opts:
+    if opt in ("-h", "--help"):
+      usage()
+      sys.exit(0)
+    elif opt in ("-a", "--address"): address = arg
+    elif opt in ("-d", "--data"): datafile = arg
+    elif opt in ("-r", "--ratelimit"): ratelimit = int(arg)
+    elif opt in ("-e", "--errors"): errors = float(arg)
+    elif opt in ("-l", "--latency"): latency = float(arg)
+    elif opt in ("-v", "--verbose"): verbose += 1
+    elif opt in ("-q", "--quiet"): verbose -= 1
+
+  if ":" not in address: exit("Address must be <host>:<port>. Exit.")
+  (host,port) = address.rsplit(":", 1)
+  server = ThrottleServer((host, int(port)), ThrottleHandler)
+  server.ratelimit = ratelimit
+  server.errors = errors
+  server.latency = latency
+  server.verbose = verbose
+  server.items = None
+  if datafile:
+    with open(datafile, "r", encoding="UTF-8") as f:
+      server.items = json.load(f)["items"]
+  server.lock = threading.Lock()
+  server.recent = deque() # times of passed calls in last second
+  server.calls = 0
+  server.throttled = 0
+  server.failed = 0
+  if verbose: show("listening at %s"%(address,))
+  # stop cleanly on kill (SIGTERM) as well as on Ctrl-C
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+    if verbose: show("%d calls, %d throttled, %d failed"%(server.calls,server.throttled,server.failed,))
+
+if __name__ == "__main__":
+  main(sys.argv[1:])